@@ -0,0 +1,157 @@
+"""
+Local stand-in for the Anthropic Messages and OpenAI Chat Completions APIs.
+
+Point the backend at it with ANTHROPIC_BASE_URL=http://localhost:9000 and
+OPENAI_BASE_URL=http://localhost:9000/v1 to benchmark without real providers.
+Latency, jitter, streaming speed and error injection are set on the command line.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Mock LLM Provider")
+
+# Overridden from the command line in __main__
+config = {
+    "latency_ms": 200.0,  # time to first token
+    "jitter_ms": 50.0,  # uniform +/- jitter added to latency
+    "chunk_delay_ms": 10.0,  # delay between streamed chunks
+    "chunks": 20,  # streamed chunks per response
+    "error_rate": 0.0,  # fraction of calls answered with 500
+    "rate_limit_rate": 0.0,  # fraction of calls answered with 429
+    "reply": '{"answer": "This is a benchmark response from the mock provider.", "confidence": 0.9}'
+}
+
+stats = {"requests": 0, "streams": 0, "errors": 0, "rate_limited": 0}
+
+async def simulate_latency():
+    jitter = random.uniform(-config["jitter_ms"], config["jitter_ms"])
+    await asyncio.sleep(max(0.0, config["latency_ms"] + jitter) / 1000)
+
+def injected_error():
+    """Return an error response for the configured fraction of calls"""
+    roll = random.random()
+    if roll < config["rate_limit_rate"]:
+        stats["rate_limited"] += 1
+        return JSONResponse(
+            status_code=429,
+            content={"type": "error", "error": {"type": "rate_limit_error", "message": "Mock rate limit"}},
+            headers={"retry-after": "1"}
+        )
+    if roll < config["rate_limit_rate"] + config["error_rate"]:
+        stats["errors"] += 1
+        return JSONResponse(
+            status_code=500,
+            content={"type": "error", "error": {"type": "api_error", "message": "Mock provider error"}}
+        )
+    return None
+
+def reply_chunks():
+    """Split the reply into the configured number of chunks"""
+    text = "```json\n" + config["reply"] + "\n```"
+    size = max(1, -(-len(text) // max(1, config["chunks"])))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+def sse(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+async def anthropic_stream(model: str):
+    yield sse({
+        "type": "message_start",
+        "message": {
+            "id": "msg_mock", "type": "message", "role": "assistant", "content": [], "model": model,
+            "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": 10, "output_tokens": 0}
+        }
+    }, "message_start")
+    yield sse({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, "content_block_start")
+    for chunk in reply_chunks():
+        yield sse({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}}, "content_block_delta")
+        await asyncio.sleep(config["chunk_delay_ms"] / 1000)
+    yield sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+    yield sse({
+        "type": "message_delta",
+        "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+        "usage": {"output_tokens": config["chunks"]}
+    }, "message_delta")
+    yield sse({"type": "message_stop"}, "message_stop")
+
+async def openai_stream(model: str):
+    for chunk in reply_chunks():
+        yield sse({
+            "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]
+        })
+        await asyncio.sleep(config["chunk_delay_ms"] / 1000)
+    yield sse({
+        "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+    })
+    yield "data: [DONE]\n\n"
+
+@app.post("/v1/messages")
+async def messages(request: Request):
+    """Anthropic Messages API"""
+    body = await request.json()
+    stats["requests"] += 1
+    await simulate_latency()
+    error = injected_error()
+    if error is not None:
+        return error
+
+    if body.get("stream"):
+        stats["streams"] += 1
+        return StreamingResponse(anthropic_stream(body["model"]), media_type="text/event-stream")
+    return {
+        "id": "msg_mock", "type": "message", "role": "assistant", "model": body["model"],
+        "content": [{"type": "text", "text": "".join(reply_chunks())}],
+        "stop_reason": "end_turn", "stop_sequence": None,
+        "usage": {"input_tokens": 10, "output_tokens": config["chunks"]}
+    }
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    """OpenAI Chat Completions API"""
+    body = await request.json()
+    stats["requests"] += 1
+    await simulate_latency()
+    error = injected_error()
+    if error is not None:
+        return error
+
+    if body.get("stream"):
+        stats["streams"] += 1
+        return StreamingResponse(openai_stream(body["model"]), media_type="text/event-stream")
+    return {
+        "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(reply_chunks())}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": config["chunks"], "total_tokens": 10 + config["chunks"]}
+    }
+
+@app.get("/health")
+async def health():
+    return {"status": "healthy", "config": config, "stats": stats}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mock Anthropic/OpenAI provider for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=config["latency_ms"])
+    parser.add_argument("--jitter-ms", type=float, default=config["jitter_ms"])
+    parser.add_argument("--chunk-delay-ms", type=float, default=config["chunk_delay_ms"])
+    parser.add_argument("--chunks", type=int, default=config["chunks"])
+    parser.add_argument("--error-rate", type=float, default=config["error_rate"])
+    parser.add_argument("--rate-limit-rate", type=float, default=config["rate_limit_rate"])
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    import uvicorn
+    args = parse_args()
+    for key in ("latency_ms", "jitter_ms", "chunk_delay_ms", "chunks", "error_rate", "rate_limit_rate"):
+        config[key] = getattr(args, key)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
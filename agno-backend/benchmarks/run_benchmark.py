@@ -0,0 +1,336 @@
+"""
+Benchmark the backend against the local mock provider.
+
+Starts benchmarks/mock_provider.py and the backend under uvicorn, then drives
+each endpoint in a closed loop at fixed concurrency levels for every worker
+count. Reports req/s, p50/p95/p99 latency and RSS of the backend processes and
+writes the results as JSON so runs can be compared:
+
+    python benchmarks/run_benchmark.py --workers 1,2 --concurrency 1,16,64
+    python benchmarks/run_benchmark.py --compare benchmarks/results/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = BENCHMARK_DIR.parent
+
+def chat_payload(i: int) -> Dict[str, Any]:
+    # Unique messages so the response cache and coalescing do not short-circuit the provider path
+    return {"message": f"Benchmark request {i}: summarize the schedule", "use_cache": False}
+
+def batch_payload(i: int) -> Dict[str, Any]:
+    return {"requests": [chat_payload(i * 100 + j) for j in range(8)]}
+
+def pipeline_payload(i: int) -> Dict[str, Any]:
+    return {
+        "input": {"query": f"Benchmark pipeline {i}"},
+        "steps": [
+            {"id": "intent", "message": "{{input.query}}", "use_cache": False},
+            {"id": "data", "message": "Enrich {{steps.intent}}", "use_cache": False},
+            {"id": "model", "message": "Model {{steps.intent}}", "use_cache": False},
+            {"id": "explain", "message": "Explain {{steps.model}} with {{steps.data}}", "use_cache": False}
+        ]
+    }
+
+# name -> (method, path, payload builder, streamed)
+ENDPOINTS = {
+    "health": ("GET", "/health", None, False),
+    "chat": ("POST", "/api/agent/chat", chat_payload, False),
+    "chat_stream": ("POST", "/api/agent/chat/stream", chat_payload, True),
+    "chat_batch": ("POST", "/api/agent/chat/batch", batch_payload, False),
+    "pipeline": ("POST", "/api/agent/pipeline", pipeline_payload, False)
+}
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return round(ordered[index], 2)
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "mean": round(sum(values) / len(values), 2) if values else None,
+        "max": round(max(values), 2) if values else None
+    }
+
+def process_tree(pid: int) -> List[int]:
+    """The process and all its descendants, read from /proc"""
+    parents: Dict[int, List[int]] = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        # ppid is the second field after the parenthesised command name
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        parents.setdefault(ppid, []).append(int(entry.name))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(parents.get(current, []))
+    return tree
+
+def rss_mb(pid: int) -> Optional[float]:
+    """Resident memory of the backend's process tree in MiB (Linux only)"""
+    if not Path("/proc").exists():
+        return None
+    total_kb = 0
+    for child in process_tree(pid):
+        try:
+            for line in Path(f"/proc/{child}/status").read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    total_kb += int(line.split()[1])
+                    break
+        except OSError:
+            continue
+    return round(total_kb / 1024, 1)
+
+async def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{url} exited with code {process.returncode}")
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready within {timeout}s")
+
+def stop(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def start_mock(args) -> subprocess.Popen:
+    command = [
+        sys.executable, str(BENCHMARK_DIR / "mock_provider.py"),
+        "--port", str(args.mock_port),
+        "--latency-ms", str(args.latency_ms),
+        "--jitter-ms", str(args.jitter_ms),
+        "--chunk-delay-ms", str(args.chunk_delay_ms),
+        "--chunks", str(args.chunks),
+        "--error-rate", str(args.error_rate),
+        "--rate-limit-rate", str(args.rate_limit_rate)
+    ]
+    return subprocess.Popen(command, cwd=BENCHMARK_DIR)
+
+def start_backend(args, workers: int) -> subprocess.Popen:
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    env = {
+        **os.environ,
+        "ANTHROPIC_API_KEY": "mock-key",
+        "OPENAI_API_KEY": "mock-key",
+        "ANTHROPIC_BASE_URL": mock_url,
+        "OPENAI_BASE_URL": f"{mock_url}/v1",
+        "PROVIDER_MAX_RETRIES": "0",
+        "LOG_LEVEL": "WARNING"
+    }
+    if not args.cache:
+        env["RESPONSE_CACHE_ENABLED"] = "false"
+    command = [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", "127.0.0.1", "--port", str(args.port),
+        "--workers", str(workers), "--log-level", "warning", "--no-access-log"
+    ]
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+
+async def run_level(client: httpx.AsyncClient, endpoint: str, concurrency: int,
+                    duration: float, backend_pid: int) -> Dict[str, Any]:
+    """Closed-loop load: concurrency clients each send requests back to back"""
+    method, path, payload, streamed = ENDPOINTS[endpoint]
+    latencies: List[float] = []
+    first_bytes: List[float] = []
+    status_codes: Dict[str, int] = {}
+    errors = 0
+    counter = iter(range(10 ** 9))
+    deadline = time.perf_counter() + duration
+
+    async def request_once():
+        nonlocal errors
+        body = payload(next(counter)) if payload else None
+        start = time.perf_counter()
+        try:
+            async with client.stream(method, path, json=body) as response:
+                first_byte = None
+                async for _ in response.aiter_raw():
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - start
+                status = str(response.status_code)
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+            first_byte = None
+        elapsed = time.perf_counter() - start
+        status_codes[status] = status_codes.get(status, 0) + 1
+        if status != "200":
+            errors += 1
+            return
+        latencies.append(elapsed * 1000)
+        if streamed and first_byte is not None:
+            first_bytes.append(first_byte * 1000)
+
+    async def client_loop():
+        while time.perf_counter() < deadline:
+            await request_once()
+
+    rss_samples: List[float] = []
+
+    async def sample_rss():
+        while time.perf_counter() < deadline:
+            rss = rss_mb(backend_pid)
+            if rss is not None:
+                rss_samples.append(rss)
+            await asyncio.sleep(0.5)
+
+    started = time.perf_counter()
+    await asyncio.gather(sample_rss(), *[client_loop() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    result = {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "duration_seconds": round(elapsed, 2),
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "status_codes": status_codes,
+        "req_per_sec": round(len(latencies) / elapsed, 2),
+        "latency_ms": summarize(latencies),
+        "rss_mb": {
+            "peak": max(rss_samples) if rss_samples else None,
+            "end": rss_mb(backend_pid)
+        }
+    }
+    if streamed:
+        result["first_byte_ms"] = summarize(first_bytes)
+    return result
+
+async def run_workers(args, workers: int) -> List[Dict[str, Any]]:
+    backend = start_backend(args, workers)
+    results = []
+    try:
+        await wait_until_ready(f"http://127.0.0.1:{args.port}/health", backend)
+        limits = httpx.Limits(max_connections=max(args.concurrency) * 2, max_keepalive_connections=max(args.concurrency))
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{args.port}", limits=limits, timeout=args.timeout
+        ) as client:
+            for endpoint in args.endpoints:
+                for concurrency in args.concurrency:
+                    if args.warmup > 0:
+                        await run_level(client, endpoint, concurrency, args.warmup, backend.pid)
+                    result = await run_level(client, endpoint, concurrency, args.duration, backend.pid)
+                    result["workers"] = workers
+                    results.append(result)
+                    print_result(result)
+    finally:
+        stop(backend)
+    return results
+
+def print_result(result: Dict[str, Any]):
+    latency = result["latency_ms"]
+    print(
+        f"workers={result['workers']:<2} {result['endpoint']:<12} c={result['concurrency']:<4} "
+        f"{result['req_per_sec']:>9.1f} req/s  p50={latency['p50']}ms p95={latency['p95']}ms "
+        f"p99={latency['p99']}ms  errors={result['errors']}  rss={result['rss_mb']['peak']}MiB",
+        flush=True
+    )
+
+def compare(results: List[Dict[str, Any]], baseline_path: str):
+    """Print req/s and p95 changes against a previous run"""
+    baseline = json.loads(Path(baseline_path).read_text())
+    previous = {(r["workers"], r["endpoint"], r["concurrency"]): r for r in baseline["results"]}
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        before = previous.get((result["workers"], result["endpoint"], result["concurrency"]))
+        if before is None or not before["req_per_sec"] or not before["latency_ms"]["p95"]:
+            continue
+        throughput = (result["req_per_sec"] / before["req_per_sec"] - 1) * 100
+        p95 = ((result["latency_ms"]["p95"] or 0) / before["latency_ms"]["p95"] - 1) * 100
+        print(
+            f"workers={result['workers']:<2} {result['endpoint']:<12} c={result['concurrency']:<4} "
+            f"req/s {throughput:+.1f}%  p95 {p95:+.1f}%"
+        )
+
+def parse_list(value: str) -> List[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the agno backend against a mock provider")
+    parser.add_argument("--endpoints", type=parse_list, default=["chat", "chat_stream", "chat_batch", "pipeline"],
+                        help=f"Comma-separated endpoints: {', '.join(ENDPOINTS)}")
+    parser.add_argument("--concurrency", type=lambda v: [int(c) for c in parse_list(v)], default=[1, 16, 64])
+    parser.add_argument("--workers", type=lambda v: [int(w) for w in parse_list(v)], default=[1])
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds measured per level")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Unmeasured seconds before each level")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--mock-port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--jitter-ms", type=float, default=50.0)
+    parser.add_argument("--chunk-delay-ms", type=float, default=10.0)
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--cache", action="store_true", help="Keep the response cache enabled")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="Previous results file to compare against")
+    args = parser.parse_args(argv)
+    unknown = [e for e in args.endpoints if e not in ENDPOINTS]
+    if unknown:
+        parser.error(f"Unknown endpoints: {', '.join(unknown)}")
+    return args
+
+async def main(args):
+    started_at = datetime.now()
+    mock = start_mock(args)
+    results = []
+    try:
+        await wait_until_ready(f"http://127.0.0.1:{args.mock_port}/health", mock)
+        for workers in args.workers:
+            results.extend(await run_workers(args, workers))
+    finally:
+        stop(mock)
+
+    output = Path(args.output) if args.output else BENCHMARK_DIR / "results" / f"{started_at:%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    config = {k: v for k, v in vars(args).items() if k not in ("output", "compare")}
+    output.write_text(json.dumps({
+        "timestamp": started_at.isoformat(),
+        "config": config,
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "results": results
+    }, indent=2))
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
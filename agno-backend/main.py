@@ -1,22 +1,44 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse, ORJSONResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any, List, Union
+from typing import Optional, Dict, Any, List, Tuple, Union, AsyncIterator, Awaitable, Callable
 import os
+import fcntl
 from dotenv import load_dotenv
 import logging
 import anthropic
 import openai
+import httpx
+import asyncio
 from datetime import datetime
 import re
 import json
+import orjson
+import jsonschema
+import numpy as np
+import time
+import hashlib
+import sqlite3
+import threading
+import uuid
+import sys
+import traceback
+import contextvars
+import heapq
+import itertools
+import math
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict, deque
+from functools import lru_cache
 
 # Load environment variables
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 def format_sources(sources):
@@ -46,39 +68,161 @@ def clean_json_response(response: str) -> Union[str, dict]:
         if isinstance(response, dict):
             return response
         
-        # Try to parse as JSON first
-        try:
-            parsed = json.loads(response)
-            return parsed
-        except json.JSONDecodeError:
-            pass
-        
-        # If not JSON, clean up markdown formatting
+        # Strip markdown formatting, then parse once
         cleaned = response.strip()
         if cleaned.startswith("```json"):
             cleaned = cleaned[7:]
         if cleaned.endswith("```"):
             cleaned = cleaned[:-3]
         
-        # Try to parse again after cleaning
         try:
             return json.loads(cleaned)
         except json.JSONDecodeError:
-            # If still not JSON, return as is
+            # If not JSON, return as is
             return cleaned
     except Exception as e:
         logger.error(f"Error cleaning JSON response: {str(e)}")
         return response
 
+JSON_START = re.compile(r"[\[{]")
+json_decoder = json.JSONDecoder()
+
+def extract_json(text: str) -> Any:
+    """Return the first complete JSON object or array in text.
+
+    Prose and code fences around the value are skipped; raw_decode parses the
+    value in place from its opening bracket, so nothing is sliced or re-parsed.
+    """
+    for match in JSON_START.finditer(text):
+        try:
+            value, _ = json_decoder.raw_decode(text, match.start())
+            return value
+        except json.JSONDecodeError:
+            continue
+    raise ValueError("Response did not contain a JSON object or array")
+
+# Structured output configuration
+STRUCTURED_OUTPUT_MAX_REPAIRS = int(os.getenv("STRUCTURED_OUTPUT_MAX_REPAIRS", "1"))
+STRUCTURED_OUTPUT_MAX_ERRORS = 5  # validation errors reported per attempt
+
+SCHEMA_CACHE_SIZE = 256
+schema_validators: "OrderedDict[str, Any]" = OrderedDict()  # schema sha256 -> validator
+
+def compile_schema(schema: Dict[str, Any]):
+    """Build a validator for a response_schema"""
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    root_type = schema.get("type")
+    if root_type is not None:
+        # Answers are extracted from the completion as a JSON object or array
+        root_types = {root_type} if isinstance(root_type, str) else set(root_type)
+        if not root_types & {"object", "array"}:
+            raise HTTPException(status_code=400, detail="Invalid response_schema: the root must be an object or array")
+    return validator_class(schema, format_checker=validator_class.FORMAT_CHECKER)
+
+def get_schema_validator(schema: Dict[str, Any]):
+    """Precompiled validator for a request's response_schema, cached by the schema's hash"""
+    key = hashlib.sha256(orjson.dumps(schema, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    validator = schema_validators.get(key)
+    if validator is not None:
+        schema_validators.move_to_end(key)
+        return validator
+    
+    try:
+        validator = compile_schema(schema)
+    except jsonschema.SchemaError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid response_schema: {e.message}")
+    schema_validators[key] = validator
+    if len(schema_validators) > SCHEMA_CACHE_SIZE:
+        schema_validators.popitem(last=False)
+    return validator
+
+def structured_output_instruction(schema: Dict[str, Any]) -> str:
+    return (
+        "\n\nRespond with only a JSON value that validates against this JSON Schema:\n"
+        f"{orjson.dumps(schema).decode()}"
+    )
+
+def validate_output(response: Any, validator) -> Tuple[Any, List[str]]:
+    """Extract the JSON value from a response and list its schema violations"""
+    value = response
+    if isinstance(response, str):
+        try:
+            value = extract_json(response)
+        except ValueError as e:
+            return None, [str(e)]
+    
+    errors = sorted(validator.iter_errors(value), key=lambda e: [str(p) for p in e.absolute_path])
+    return value, [
+        f"{'/'.join(str(p) for p in error.absolute_path) or '<root>'}: {error.message}"
+        for error in errors[:STRUCTURED_OUTPUT_MAX_ERRORS]
+    ]
+
+class JsonFenceStripper:
+    """Strip a ```json code fence from a completion while it is being streamed"""
+
+    FENCE = "```"
+    JSON_FENCE = "```json"
+
+    def __init__(self):
+        self._head = ""
+        self._started = False
+        self._tail = ""
+
+    def feed(self, delta: str) -> str:
+        """Consume a token delta and return the text that is safe to emit"""
+        if not self._started:
+            self._head += delta
+            stripped = self._head.lstrip()
+            # Wait until we know whether the completion opens with a fence
+            if self.JSON_FENCE.startswith(stripped):
+                return ""
+            self._started = True
+            if stripped.startswith(self.JSON_FENCE):
+                stripped = stripped[len(self.JSON_FENCE):]
+            elif stripped.startswith(self.FENCE):
+                stripped = stripped[len(self.FENCE):]
+            delta = stripped.lstrip("\n")
+        
+        # Hold back trailing whitespace and backticks that may be the closing fence
+        text = self._tail + delta
+        end = len(text)
+        while end > 0 and (text[end - 1].isspace() or text[end - 1] == "`"):
+            end -= 1
+        self._tail = text[end:]
+        return text[:end]
+
+    def finish(self) -> str:
+        """Flush any held-back text once the stream has ended"""
+        if not self._started:
+            return self._head.strip().removeprefix(self.JSON_FENCE).strip()
+        tail = self._tail.rstrip()
+        if tail.endswith(self.FENCE):
+            tail = tail[:-len(self.FENCE)]
+        return tail.rstrip()
+
+def sse_event(event: str, data: Any) -> str:
+    """Encode a Server-Sent Event frame"""
+    return f"event: {event}\ndata: {orjson.dumps(data, default=jsonable_encoder).decode()}\n\n"
+
 def format_rag_response(answer: str, sources: list) -> str:
     """Format RAG response with properly formatted sources"""
     formatted_sources = format_sources(sources)
     return f"# Knowledge Response\n\n{answer}\n\n**Sources:**\n{formatted_sources}"
 
+def format_agent_response(response: Union[str, dict]) -> Union[str, dict]:
+    """Format the response if it's a RAG result"""
+    if isinstance(response, dict) and "ragResult" in response:
+        rag_result = response["ragResult"]
+        if "answer" in rag_result and "sources" in rag_result:
+            return format_rag_response(rag_result["answer"], rag_result["sources"])
+    return response
+
 app = FastAPI(
     title="Agno Backend API",
     description="AI agents with support for Anthropic and OpenAI models",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware for local development
@@ -90,15 +234,1722 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize API clients
-anthropic_client = None
-openai_client = None
+# Metrics configuration
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SLOW_REQUEST_PROFILE_MS = float(os.getenv("SLOW_REQUEST_PROFILE_MS", "0"))  # 0 disables the profiler
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_TOP_STACKS = int(os.getenv("PROFILE_TOP_STACKS", "5"))
+
+class Metric:
+    """A Prometheus counter, gauge or histogram with optional labels"""
+
+    def __init__(self, name: str, help_text: str, kind: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.label_names = label_names
+        self.buckets = buckets
+        self._values: Dict[tuple, Any] = {}
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def _labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.label_names, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self._values.items():
+            if self.kind == "histogram":
+                counts, total, count = value
+                for bound, bucket_count in zip(self.buckets, counts):
+                    bucket_labels = self._labels(key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {bucket_count}")
+                inf_labels = self._labels(key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{inf_labels} {count}")
+                lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+                lines.append(f"{self.name}_count{self._labels(key)} {count}")
+            else:
+                lines.append(f"{self.name}{self._labels(key)} {value}")
+        return lines
+
+http_requests_total = Metric("agno_http_requests_total", "HTTP requests served", "counter", ("handler", "method", "status"))
+http_request_duration = Metric("agno_http_request_duration_seconds", "HTTP request latency until response start", "histogram", ("handler",))
+http_requests_in_flight = Metric("agno_http_requests_in_flight", "HTTP requests being served", "gauge")
+provider_requests_total = Metric("agno_provider_requests_total", "Provider calls by outcome", "counter", ("provider", "model", "outcome"))
+provider_latency = Metric("agno_provider_latency_seconds", "Provider call latency", "histogram", ("provider", "model"))
+provider_tokens_total = Metric("agno_provider_tokens_total", "Tokens reported by providers", "counter", ("provider", "model", "direction"))
+provider_in_flight = Metric("agno_provider_in_flight", "Provider calls in flight", "gauge", ("provider",))
+provider_queued = Metric("agno_provider_queued", "Provider calls waiting for a concurrency slot", "gauge", ("provider",))
+stage_duration = Metric("agno_stage_duration_seconds", "Time spent per request stage", "histogram", ("stage",))
+
+METRICS = [
+    http_requests_total, http_request_duration, http_requests_in_flight,
+    provider_requests_total, provider_latency, provider_tokens_total,
+    provider_in_flight, provider_queued, stage_duration
+]
+
+# Per-request stage timings, reported in the Server-Timing header
+request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("request_timings", default=None)
+
+def record_stage(stage: str, seconds: float):
+    """Add time spent in a stage to the current request and the stage histogram"""
+    stage_duration.observe(seconds, stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+@contextmanager
+def timed_stage(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+class SlowRequestProfiler:
+    """Samples event loop stacks from one shared thread while requests run past a threshold.
+
+    Each tick takes a single stack sample per busy loop thread and credits it
+    to every request on that loop that is over the threshold, so a slow
+    request's report shows what kept its loop busy, including other requests'
+    work. A loop counts as busy when its heartbeat callback is running late;
+    an idle loop (waiting on I/O in select, epoll or uvloop) is not sampled.
+    """
+
+    def __init__(self, threshold_ms: float, interval_ms: float, top_stacks: int):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.top_stacks = top_stacks
+        self._requests: Dict[int, Dict[str, Any]] = {}
+        self._in_flight: Dict[int, int] = {}  # loop thread id -> tracked requests
+        self._heartbeats: Dict[int, float] = {}  # loop thread id -> last heartbeat
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, path: str) -> int:
+        """Track a request running on the current event loop"""
+        thread_id = threading.get_ident()
+        now = time.perf_counter()
+        request = {"path": path, "thread_id": thread_id, "started": now, "samples": {}}
+        with self._lock:
+            request_id = next(self._ids)
+            self._requests[request_id] = request
+            self._in_flight[thread_id] = self._in_flight.get(thread_id, 0) + 1
+            beating = thread_id in self._heartbeats
+            if not beating:
+                self._heartbeats[thread_id] = now
+            self._active.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+                self._thread.start()
+        if not beating:
+            loop = asyncio.get_running_loop()
+            loop.call_later(self.interval, self._heartbeat, loop, thread_id)
+        return request_id
+
+    def _heartbeat(self, loop: asyncio.AbstractEventLoop, thread_id: int):
+        # Runs on the loop; beats only while the loop has tracked requests
+        with self._lock:
+            if not self._in_flight.get(thread_id):
+                self._heartbeats.pop(thread_id, None)
+                return
+            self._heartbeats[thread_id] = time.perf_counter()
+        loop.call_later(self.interval, self._heartbeat, loop, thread_id)
+
+    def _run(self):
+        while True:
+            # Idle until a request is in flight
+            self._active.wait()
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            with self._lock:
+                if not self._requests:
+                    self._active.clear()
+                    continue
+                # A heartbeat more than two intervals late means the loop is running code
+                threads = {
+                    request["thread_id"] for request in self._requests.values()
+                    if now - request["started"] >= self.threshold
+                    and now - self._heartbeats.get(request["thread_id"], now) > 2 * self.interval
+                }
+            if not threads:
+                continue
+            
+            frames = sys._current_frames()
+            stacks = {thread_id: self._stack(frames.get(thread_id)) for thread_id in threads}
+            with self._lock:
+                for request in self._requests.values():
+                    stack = stacks.get(request["thread_id"])
+                    if stack is not None and now - request["started"] >= self.threshold:
+                        request["samples"][stack] = request["samples"].get(stack, 0) + 1
+
+    @staticmethod
+    def _stack(frame) -> Optional[str]:
+        if frame is None:
+            return None
+        return ";".join(f"{f.name}:{f.lineno}" for f in traceback.extract_stack(frame)[-8:])
+
+    def stop(self, request_id: int, elapsed: float):
+        """Stop tracking a request and log its hottest stacks if it was sampled"""
+        with self._lock:
+            request = self._requests.pop(request_id)
+            self._in_flight[request["thread_id"]] -= 1
+        if not request["samples"]:
+            return
+        top = sorted(request["samples"].items(), key=lambda item: item[1], reverse=True)[:self.top_stacks]
+        report = "\n".join(f"  {count} samples: {stack}" for stack, count in top)
+        logger.warning(f"Slow request {request['path']} took {elapsed * 1000:.0f}ms; hottest event loop stacks while it ran:\n{report}")
+
+slow_request_profiler = (
+    SlowRequestProfiler(SLOW_REQUEST_PROFILE_MS, PROFILE_SAMPLE_INTERVAL_MS, PROFILE_TOP_STACKS)
+    if SLOW_REQUEST_PROFILE_MS > 0 else None
+)
+
+class ServerTimingMiddleware:
+    """Records request metrics and adds a Server-Timing header with per-stage durations"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        timings: Dict[str, float] = {}
+        token = request_timings.set(timings)
+        started = time.perf_counter()
+        status = {"code": 500}
+        profile_id = None
+        if slow_request_profiler is not None:
+            profile_id = slow_request_profiler.start(scope["path"])
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                elapsed = time.perf_counter() - started
+                handler = getattr(scope.get("endpoint"), "__name__", "unmatched")
+                http_request_duration.observe(elapsed, handler=handler)
+                entries = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items()]
+                entries.append(f"total;dur={elapsed * 1000:.2f}")
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", ", ".join(entries).encode("latin-1"))
+                ]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            http_requests_in_flight.dec()
+            handler = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            http_requests_total.inc(handler=handler, method=scope["method"], status=status["code"])
+            request_timings.reset(token)
+            if profile_id is not None:
+                slow_request_profiler.stop(profile_id, time.perf_counter() - started)
+
+app.add_middleware(ServerTimingMiddleware)
+
+# Async provider clients share one pooled HTTP transport so a single worker
+# can keep many provider calls in flight without blocking the event loop
+PROVIDER_TIMEOUT_SECONDS = float(os.getenv("PROVIDER_TIMEOUT_SECONDS", "60"))
+PROVIDER_CONNECT_TIMEOUT_SECONDS = float(os.getenv("PROVIDER_CONNECT_TIMEOUT_SECONDS", "5"))
+PROVIDER_MAX_RETRIES = int(os.getenv("PROVIDER_MAX_RETRIES", "2"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "500"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "100"))
+ANTHROPIC_MAX_CONCURRENCY = int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", "200"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "200"))
+
+provider_timeout = httpx.Timeout(PROVIDER_TIMEOUT_SECONDS, connect=PROVIDER_CONNECT_TIMEOUT_SECONDS)
+async_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS
+    ),
+    timeout=provider_timeout
+)
+
+async_anthropic_client = None
+async_openai_client = None
 
 if os.getenv("ANTHROPIC_API_KEY"):
-    anthropic_client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+    async_anthropic_client = anthropic.AsyncAnthropic(
+        api_key=os.getenv("ANTHROPIC_API_KEY"),
+        http_client=async_http_client,
+        timeout=provider_timeout,
+        max_retries=PROVIDER_MAX_RETRIES
+    )
 
 if os.getenv("OPENAI_API_KEY"):
-    openai_client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    async_openai_client = openai.AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=async_http_client,
+        timeout=provider_timeout,
+        max_retries=PROVIDER_MAX_RETRIES
+    )
+
+# Per-provider concurrency limits for in-flight calls
+provider_semaphores = {
+    "anthropic": asyncio.Semaphore(ANTHROPIC_MAX_CONCURRENCY),
+    "openai": asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+}
+
+@asynccontextmanager
+async def provider_slot(provider: str):
+    """Hold one of the provider's concurrency slots, tracking queued and in-flight calls"""
+    semaphore = provider_semaphores[provider]
+    provider_queued.inc(provider=provider)
+    try:
+        await semaphore.acquire()
+    finally:
+        provider_queued.dec(provider=provider)
+    
+    provider_in_flight.inc(provider=provider)
+    try:
+        yield
+    finally:
+        provider_in_flight.dec(provider=provider)
+        semaphore.release()
+
+def record_provider_call(model_config: Dict[str, str], started: float, outcome: str,
+                         input_tokens: Optional[int] = None, output_tokens: Optional[int] = None):
+    """Record latency, outcome and token usage for one provider call"""
+    elapsed = time.perf_counter() - started
+    labels = {"provider": model_config["provider"], "model": model_config["model_id"]}
+    provider_requests_total.inc(outcome=outcome, **labels)
+    if outcome == "ok":
+        provider_latency.observe(elapsed, **labels)
+    if input_tokens:
+        provider_tokens_total.inc(input_tokens, direction="input", **labels)
+    if output_tokens:
+        provider_tokens_total.inc(output_tokens, direction="output", **labels)
+    record_stage("provider", elapsed)
+
+# Response cache configuration
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB")
+RESPONSE_CACHE_DB_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_DB_MAX_ENTRIES", "100000"))
+RESPONSE_CACHE_PRUNE_SECONDS = float(os.getenv("RESPONSE_CACHE_PRUNE_SECONDS", "60"))
+# Sampled calls above this temperature are only cached when use_cache is explicitly true
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "0.3"))
+# Part of every cache key; bump when the shape of cached values changes
+RESPONSE_CACHE_FORMAT = 2
+
+class ResponseCache:
+    """Content-addressed cache of agent responses.
+
+    The first tier is an in-memory LRU with TTL. The optional second tier is a
+    SQLite file that survives restarts and is shared by all workers on a host;
+    writes periodically prune expired rows and cap it at db_max_entries.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, db_path: Optional[str] = None, enabled: bool = True,
+                 db_max_entries: int = 100000, prune_seconds: float = 60):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self.db_max_entries = db_max_entries
+        self.prune_seconds = prune_seconds
+        self.pruned = 0
+        self._last_prune = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._db = None
+        self._db_lock = threading.Lock()
+        if enabled and db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS response_cache_expires ON response_cache (expires_at)")
+
+    @staticmethod
+    def make_key(provider: str, model_id: str, system: str, messages: List[Dict[str, Any]],
+                 temperature: float, max_tokens: int) -> str:
+        """Hash everything that determines the provider's answer"""
+        payload = json.dumps(
+            [RESPONSE_CACHE_FORMAT, provider, model_id, system, messages, temperature, max_tokens],
+            sort_keys=True,
+            separators=(",", ":")
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Look up a cached response, falling back to the SQLite tier"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        
+        if self._db is not None:
+            try:
+                value = await asyncio.to_thread(self._db_get, key)
+            except sqlite3.Error as e:
+                logger.warning(f"Response cache read failed: {str(e)}")
+                value = None
+            if value is not None:
+                self._remember(key, value)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+        
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: Any):
+        """Store a response in both tiers"""
+        self._remember(key, value)
+        if self._db is not None:
+            try:
+                await asyncio.to_thread(self._db_set, key, value)
+            except sqlite3.Error as e:
+                logger.warning(f"Response cache write failed: {str(e)}")
+
+    def _remember(self, key: str, value: Any):
+        self._entries[key] = (time.time() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _db_get(self, key: str) -> Optional[Any]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= time.time():
+                self._db.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None
+            return json.loads(row[0])
+
+    def _db_set(self, key: str, value: Any):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + self.ttl_seconds)
+            )
+            if time.time() - self._last_prune >= self.prune_seconds:
+                self._prune()
+
+    def _prune(self):
+        """Drop expired rows, then the oldest rows beyond db_max_entries"""
+        now = time.time()
+        self._last_prune = now
+        deleted = self._db.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,)).rowcount
+        excess = self._db.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0] - self.db_max_entries
+        if excess > 0:
+            # Every row has the same TTL, so the earliest expiry is the oldest write
+            deleted += self._db.execute(
+                "DELETE FROM response_cache WHERE key IN "
+                "(SELECT key FROM response_cache ORDER BY expires_at LIMIT ?)", (excess,)
+            ).rowcount
+        self.pruned += deleted
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for the health endpoint"""
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "persistent": self._db is not None,
+            "pruned": self.pruned
+        }
+
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+    db_path=RESPONSE_CACHE_DB,
+    enabled=RESPONSE_CACHE_ENABLED,
+    db_max_entries=RESPONSE_CACHE_DB_MAX_ENTRIES,
+    prune_seconds=RESPONSE_CACHE_PRUNE_SECONDS
+)
+
+REQUEST_COALESCING_ENABLED = os.getenv("REQUEST_COALESCING_ENABLED", "true").lower() == "true"
+
+class StreamBroadcast:
+    """Fan one upstream token stream out to every subscriber, replaying missed deltas"""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None  # pumps the upstream stream
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        # Waiters hold the old event, so swapping in a fresh one wakes all of them
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+class RequestCoalescer:
+    """Single-flight execution: concurrent identical requests share one upstream call"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, StreamBroadcast] = {}
+
+    async def run(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Await the in-flight call for key, starting it if there is none"""
+        if not self.enabled:
+            return await call()
+        
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._release(self._calls, key, t))
+        else:
+            self.coalesced += 1
+        
+        # Shield so one caller disconnecting does not cancel the shared call
+        return await asyncio.shield(task)
+
+    async def stream(self, key: str, open_stream: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Subscribe to the in-flight stream for key, starting it if there is none"""
+        if not self.enabled:
+            async for chunk in open_stream():
+                yield chunk
+            return
+        
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            self.leaders += 1
+            broadcast = StreamBroadcast()
+            self._streams[key] = broadcast
+
+            async def pump():
+                try:
+                    async for chunk in open_stream():
+                        broadcast.publish(chunk)
+                    broadcast.finish()
+                except asyncio.CancelledError as e:
+                    broadcast.finish(e)
+                    raise
+                except Exception as e:
+                    broadcast.finish(e)
+
+            broadcast.task = asyncio.ensure_future(pump())
+            broadcast.task.add_done_callback(lambda t: self._release(self._streams, key, broadcast))
+        else:
+            self.coalesced += 1
+        
+        broadcast.subscribers += 1
+        try:
+            async for chunk in broadcast.subscribe():
+                yield chunk
+        finally:
+            broadcast.subscribers -= 1
+            if not broadcast.subscribers and not broadcast.done:
+                # Every subscriber has gone: stop paying for the provider stream
+                self._release(self._streams, key, broadcast)
+                broadcast.task.cancel()
+
+    @staticmethod
+    def _release(registry: Dict[str, Any], key: str, entry: Any):
+        if registry.get(key) is entry:
+            del registry[key]
+        if isinstance(entry, asyncio.Task) and not entry.cancelled():
+            entry.exception()  # mark retrieved when every waiter has gone away
+
+    def stats(self) -> Dict[str, Any]:
+        """Coalescing counters for the health endpoint"""
+        return {
+            "enabled": self.enabled,
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls) + len(self._streams)
+        }
+
+request_coalescer = RequestCoalescer(enabled=REQUEST_COALESCING_ENABLED)
+
+# Session memory configuration
+SESSION_IDLE_SECONDS = float(os.getenv("SESSION_IDLE_SECONDS", "1800"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "50"))
+SESSION_HISTORY_TOKEN_BUDGET = int(os.getenv("SESSION_HISTORY_TOKEN_BUDGET", "4000"))
+
+# Provider-side prompt caching for long, repeated prefixes
+PROMPT_CACHING_ENABLED = os.getenv("PROMPT_CACHING_ENABLED", "true").lower() == "true"
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))
+ANTHROPIC_PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token) used for budgeting"""
+    return max(1, len(text) // 4)
+
+def render_context(context: Optional[Dict[str, Any]]) -> str:
+    """Render request context as a compact prompt section"""
+    if not context:
+        return ""
+    return f"Context:\n{json.dumps(context, separators=(',', ':'), default=str)}\n\n"
+
+TRUNCATION_MARKER = " [truncated]"
+
+class SessionStore:
+    """Server-side conversation memory keyed by session_id.
+
+    Each session keeps (user, assistant, tokens) turn tuples. Sessions idle for
+    longer than idle_seconds are dropped, and the least recently used sessions
+    are evicted once the stored text exceeds max_bytes.
+    """
+
+    SWEEP_INTERVAL_SECONDS = 60
+
+    def __init__(self, idle_seconds: float, max_bytes: int, max_turns: int):
+        self.idle_seconds = idle_seconds
+        self.max_bytes = max_bytes
+        self.max_turns = max_turns
+        self.evictions = 0
+        self._sessions: "OrderedDict[str, list]" = OrderedDict()  # id -> [turns, size, last_used]
+        self._bytes = 0
+        self._last_sweep = time.time()
+
+    def history(self, session_id: str, token_budget: int) -> List[Dict[str, str]]:
+        """Most recent turns that fit the token budget, oldest first"""
+        session = self._sessions.get(session_id)
+        if session is None:
+            return []
+        if session[2] + self.idle_seconds < time.time():
+            self._drop(session_id)
+            return []
+        session[2] = time.time()
+        self._sessions.move_to_end(session_id)
+        
+        selected = []
+        used = 0
+        for user, assistant, tokens in reversed(session[0]):
+            # Stop at the first turn that does not fit so history never has gaps;
+            # the latest turn is truncated rather than dropped
+            if used + tokens > token_budget:
+                if not selected:
+                    selected.append(self._truncate_turn(user, assistant, token_budget))
+                break
+            selected.append((user, assistant))
+            used += tokens
+        
+        messages = []
+        for user, assistant in reversed(selected):
+            messages.append({"role": "user", "content": user})
+            messages.append({"role": "assistant", "content": assistant})
+        return messages
+
+    @staticmethod
+    def _truncate_turn(user: str, assistant: str, token_budget: int) -> Tuple[str, str]:
+        """Cut a turn to the budget, splitting it between both sides"""
+        chars = max(token_budget * 4 - 2 * len(TRUNCATION_MARKER), 0)
+        user_chars = max(chars // 2, chars - len(assistant))
+        assistant_chars = chars - min(len(user), user_chars)
+        if len(user) > user_chars:
+            user = user[:user_chars] + TRUNCATION_MARKER
+        if len(assistant) > assistant_chars:
+            assistant = assistant[:assistant_chars] + TRUNCATION_MARKER
+        return user, assistant
+
+    def append(self, session_id: str, user: str, assistant: Union[str, dict]):
+        """Record a completed turn"""
+        if not isinstance(assistant, str):
+            assistant = json.dumps(assistant, separators=(",", ":"), default=str)
+        
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = [deque(), 0, time.time()]
+            self._sessions[session_id] = session
+        
+        size = len(user) + len(assistant)
+        session[0].append((user, assistant, estimate_tokens(user) + estimate_tokens(assistant)))
+        session[1] += size
+        session[2] = time.time()
+        self._bytes += size
+        self._sessions.move_to_end(session_id)
+        
+        while len(session[0]) > self.max_turns:
+            old_user, old_assistant, _ = session[0].popleft()
+            removed = len(old_user) + len(old_assistant)
+            session[1] -= removed
+            self._bytes -= removed
+        
+        self._evict()
+
+    def clear(self, session_id: str) -> bool:
+        """Forget a session"""
+        if session_id not in self._sessions:
+            return False
+        self._drop(session_id)
+        return True
+
+    def _drop(self, session_id: str):
+        session = self._sessions.pop(session_id)
+        self._bytes -= session[1]
+
+    def _evict(self):
+        now = time.time()
+        if now - self._last_sweep >= self.SWEEP_INTERVAL_SECONDS:
+            self._last_sweep = now
+            for session_id in [sid for sid, session in self._sessions.items() if session[2] + self.idle_seconds < now]:
+                self._drop(session_id)
+                self.evictions += 1
+        
+        while self._bytes > self.max_bytes and len(self._sessions) > 1:
+            self._drop(next(iter(self._sessions)))
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Session counters for the health endpoint"""
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self._bytes,
+            "evictions": self.evictions
+        }
+
+session_store = SessionStore(
+    idle_seconds=SESSION_IDLE_SECONDS,
+    max_bytes=SESSION_MAX_BYTES,
+    max_turns=SESSION_MAX_TURNS
+)
+
+# Context blob store configuration
+CONTEXT_STORE_MAX_BYTES = int(os.getenv("CONTEXT_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+CONTEXT_MAX_UPLOAD_BYTES = int(os.getenv("CONTEXT_MAX_UPLOAD_BYTES", str(8 * 1024 * 1024)))
+CONTEXT_STORE_SPILL_DIR = os.getenv("CONTEXT_STORE_SPILL_DIR")
+CONTEXT_STORE_SPILL_MAX_BYTES = int(os.getenv("CONTEXT_STORE_SPILL_MAX_BYTES", str(1024 ** 3)))
+
+CONTEXT_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+class ContextStore:
+    """Content-addressed store for large request context.
+
+    Context is parsed and rendered once on upload and kept as encoded prompt
+    text in a byte-bounded LRU. When a spill directory is configured, every
+    upload is also written through to it, so a context survives eviction and
+    restarts and can be loaded by any worker on the host. The directory is
+    capped at spill_max_bytes, dropping the least recently used files first.
+    Disk work runs in worker threads.
+    """
+
+    def __init__(self, max_bytes: int, spill_dir: Optional[str] = None, spill_max_bytes: int = 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.spill_reads = 0
+        self.spill_writes = 0
+        self._blobs: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._spill_bytes = 0
+        self._lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._spill_bytes = sum(size for _, _, size in self._spill_files())
+
+    def put(self, context: Dict[str, Any]) -> Dict[str, Any]:
+        """Render and store context, returning its content hash (blocking)"""
+        blob = render_context(context).encode("utf-8")
+        context_id = hashlib.sha256(blob).hexdigest()
+        if self.spill_dir:
+            # Written through so other workers can serve the follow-up requests
+            self._spill([(context_id, blob)])
+        self._remember(context_id, blob)
+        return {"context_id": context_id, "bytes": len(blob)}
+
+    async def get(self, context_id: str) -> Optional[str]:
+        """Rendered prompt text for a stored context"""
+        if not CONTEXT_ID_PATTERN.match(context_id):
+            return None
+        
+        with self._lock:
+            blob = self._blobs.get(context_id)
+            if blob is not None:
+                self._blobs.move_to_end(context_id)
+        if blob is not None:
+            self.hits += 1
+            return blob.decode("utf-8")
+        
+        if self.spill_dir:
+            blob = await asyncio.to_thread(self._load_spilled, context_id)
+            if blob is not None:
+                self.hits += 1
+                self.spill_reads += 1
+                return blob.decode("utf-8")
+        
+        self.misses += 1
+        return None
+
+    def flush(self):
+        """Spill every in-memory blob so the store survives a restart"""
+        if not self.spill_dir:
+            return
+        with self._lock:
+            blobs = list(self._blobs.items())
+        self._spill(blobs)
+
+    def _spill_path(self, context_id: str) -> str:
+        return os.path.join(self.spill_dir, f"{context_id}.ctx")
+
+    def _load_spilled(self, context_id: str) -> Optional[bytes]:
+        path = self._spill_path(context_id)
+        try:
+            with open(path, "rb") as f:
+                blob = f.read()
+            os.utime(path)  # mark as recently used for the spill cap
+        except FileNotFoundError:
+            return None
+        self._remember(context_id, blob)
+        return blob
+
+    def _remember(self, context_id: str, blob: bytes):
+        evicted = []
+        with self._lock:
+            if context_id in self._blobs:
+                self._blobs.move_to_end(context_id)
+                return
+            self._blobs[context_id] = blob
+            self._bytes += len(blob)
+            while self._bytes > self.max_bytes and len(self._blobs) > 1:
+                evicted_id, evicted_blob = self._blobs.popitem(last=False)
+                self._bytes -= len(evicted_blob)
+                evicted.append((evicted_id, evicted_blob))
+        if self.spill_dir and evicted:
+            # Usually already on disk; re-spilled if the spill cap deleted the file
+            self._spill(evicted)
+
+    def _spill(self, blobs: List[tuple]):
+        for context_id, blob in blobs:
+            path = self._spill_path(context_id)
+            if os.path.exists(path):
+                os.utime(path)
+                continue
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(blob)
+            os.replace(tmp_path, path)
+            self.spill_writes += 1
+            self._spill_bytes += len(blob)
+        if self._spill_bytes > self.spill_max_bytes:
+            self._prune_spill()
+
+    def _spill_files(self) -> List[tuple]:
+        """(mtime, path, size) of every spilled blob"""
+        files = []
+        for entry in os.scandir(self.spill_dir):
+            if entry.name.endswith(".ctx"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+        return files
+
+    def _prune_spill(self):
+        """Delete least recently used spill files until the directory is under 90% of its cap"""
+        files = sorted(self._spill_files())
+        total = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if total <= self.spill_max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._spill_bytes = total
+
+    def stats(self) -> Dict[str, Any]:
+        """Context store counters for the health endpoint"""
+        return {
+            "contexts": len(self._blobs),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "spill_reads": self.spill_reads,
+            "spill_writes": self.spill_writes,
+            "spill_bytes": self._spill_bytes,
+            "spill_enabled": bool(self.spill_dir)
+        }
+
+context_store = ContextStore(
+    max_bytes=CONTEXT_STORE_MAX_BYTES,
+    spill_dir=CONTEXT_STORE_SPILL_DIR,
+    spill_max_bytes=CONTEXT_STORE_SPILL_MAX_BYTES
+)
+
+# Provider routing configuration
+ROUTER_FAILOVER_ENABLED = os.getenv("ROUTER_FAILOVER_ENABLED", "true").lower() == "true"
+ROUTER_WINDOW_SECONDS = float(os.getenv("ROUTER_WINDOW_SECONDS", "60"))
+ROUTER_MIN_REQUESTS = int(os.getenv("ROUTER_MIN_REQUESTS", "5"))
+ROUTER_ERROR_THRESHOLD = float(os.getenv("ROUTER_ERROR_THRESHOLD", "0.5"))
+ROUTER_OPEN_SECONDS = float(os.getenv("ROUTER_OPEN_SECONDS", "30"))
+ROUTER_HEDGE_ENABLED = os.getenv("ROUTER_HEDGE_ENABLED", "false").lower() == "true"
+ROUTER_HEDGE_PERCENTILE = float(os.getenv("ROUTER_HEDGE_PERCENTILE", "0.95"))
+ROUTER_HEDGE_DEFAULT_DELAY_MS = float(os.getenv("ROUTER_HEDGE_DEFAULT_DELAY_MS", "3000"))
+ROUTER_HEDGE_MIN_DELAY_MS = float(os.getenv("ROUTER_HEDGE_MIN_DELAY_MS", "100"))
+
+# Models that can stand in for each other when one is slow or failing
+DEFAULT_MODEL_EQUIVALENTS = [
+    ["anthropic:claude-3-haiku-20240307", "openai:gpt-3.5-turbo"],
+    ["anthropic:claude-3-sonnet-20240229", "openai:gpt-4-turbo-preview"],
+    ["anthropic:claude-3-opus-20240229", "openai:gpt-4"]
+]
+MODEL_EQUIVALENTS = json.loads(os.getenv("ROUTER_EQUIVALENTS", "null")) or DEFAULT_MODEL_EQUIVALENTS
+
+# Client errors that another model would reject just the same
+NON_RETRIABLE_STATUS_CODES = {400, 404, 413, 422}
+
+def is_retriable_error(exc: Exception) -> bool:
+    """Whether a provider error is worth failing over for"""
+    return getattr(exc, "status_code", None) not in NON_RETRIABLE_STATUS_CODES
+
+class ModelStats:
+    """Rolling latency/error window and circuit breaker state for one model"""
+
+    MAX_SAMPLES = 1000
+
+    def __init__(self):
+        self.samples = deque(maxlen=self.MAX_SAMPLES)  # (timestamp, latency seconds or None, ok)
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def trim(self, now: float, window_seconds: float):
+        while self.samples and self.samples[0][0] < now - window_seconds:
+            self.samples.popleft()
+
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, _, ok in self.samples if not ok) / len(self.samples)
+
+    def latency_percentile(self, q: float) -> Optional[float]:
+        latencies = sorted(latency for _, latency, ok in self.samples if ok and latency is not None)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+class ProviderRouter:
+    """Routes provider calls across equivalent models.
+
+    Tracks rolling per-model latency and error rate, opens a circuit breaker
+    when a model keeps failing, fails over to an equivalent model, and can
+    hedge a duplicate request once the primary exceeds its p95 latency. The
+    provider call and the "is this provider configured" check are injected,
+    so the router can be exercised against stub providers.
+    """
+
+    def __init__(self, equivalents: List[List[str]], is_configured: Callable[[str], bool],
+                 failover: bool = True, hedge: bool = False):
+        self.is_configured = is_configured
+        self.failover = failover
+        self.hedge = hedge
+        self.failovers = 0
+        self.hedges = 0
+        self._stats: Dict[str, ModelStats] = {}
+        self._equivalents: Dict[str, List[str]] = {}
+        for group in equivalents:
+            for key in group:
+                self._equivalents[key] = [other for other in group if other != key]
+
+    @staticmethod
+    def model_key(model_config: Dict[str, str]) -> str:
+        return f"{model_config['provider']}:{model_config['model_id']}"
+
+    def stats_for(self, model_config: Dict[str, str]) -> ModelStats:
+        key = self.model_key(model_config)
+        if key not in self._stats:
+            self._stats[key] = ModelStats()
+        return self._stats[key]
+
+    def _available(self, stats: ModelStats, now: float) -> bool:
+        if stats.state == "open" and now - stats.opened_at >= ROUTER_OPEN_SECONDS:
+            stats.state = "half_open"
+            stats.probe_in_flight = False
+        if stats.state == "half_open":
+            return not stats.probe_in_flight
+        return stats.state == "closed"
+
+    def candidates(self, model_config: Dict[str, str]) -> List[Dict[str, str]]:
+        """The requested model followed by healthy equivalents"""
+        keys = [self.model_key(model_config)]
+        if self.failover:
+            keys += self._equivalents.get(keys[0], [])
+        
+        now = time.time()
+        candidates = []
+        for key in keys:
+            provider, model_id = key.split(":", 1)
+            candidate = model_config if key == keys[0] else {"provider": provider, "model_id": model_id}
+            if key != keys[0] and not self.is_configured(provider):
+                continue
+            if self._available(self.stats_for(candidate), now):
+                candidates.append(candidate)
+        
+        if not candidates:
+            raise HTTPException(
+                status_code=503,
+                detail=f"No healthy model available for {keys[0]} (circuit open)",
+                headers={"Retry-After": str(int(ROUTER_OPEN_SECONDS))}
+            )
+        return candidates
+
+    def record(self, model_config: Dict[str, str], ok: bool, latency: Optional[float] = None):
+        """Record an outcome and update the model's circuit breaker"""
+        stats = self.stats_for(model_config)
+        now = time.time()
+        stats.trim(now, ROUTER_WINDOW_SECONDS)
+        stats.samples.append((now, latency, ok))
+        
+        if stats.state == "half_open":
+            stats.probe_in_flight = False
+            if ok:
+                stats.state = "closed"
+                stats.samples.clear()
+            else:
+                stats.state = "open"
+                stats.opened_at = now
+        elif (not ok and len(stats.samples) >= ROUTER_MIN_REQUESTS
+              and stats.error_rate() >= ROUTER_ERROR_THRESHOLD):
+            stats.state = "open"
+            stats.opened_at = now
+            logger.warning(f"Circuit opened for {self.model_key(model_config)}")
+
+    def hedge_delay(self, model_config: Dict[str, str]) -> float:
+        """Seconds to wait on the primary before sending a hedged duplicate"""
+        stats = self.stats_for(model_config)
+        stats.trim(time.time(), ROUTER_WINDOW_SECONDS)
+        percentile = None
+        if len(stats.samples) >= ROUTER_MIN_REQUESTS:
+            percentile = stats.latency_percentile(ROUTER_HEDGE_PERCENTILE)
+        delay_ms = percentile * 1000 if percentile is not None else ROUTER_HEDGE_DEFAULT_DELAY_MS
+        return max(delay_ms, ROUTER_HEDGE_MIN_DELAY_MS) / 1000
+
+    async def _attempt(self, model_config: Dict[str, str],
+                       call: Callable[[Dict[str, str]], Awaitable[Any]]) -> Tuple[Any, Dict[str, str]]:
+        stats = self.stats_for(model_config)
+        if stats.state == "half_open":
+            stats.probe_in_flight = True
+        started = time.perf_counter()
+        try:
+            result = await call(model_config)
+        except asyncio.CancelledError:
+            stats.probe_in_flight = False
+            raise
+        except Exception as e:
+            if is_retriable_error(e):
+                self.record(model_config, False)
+            else:
+                stats.probe_in_flight = False
+            raise
+        self.record(model_config, True, time.perf_counter() - started)
+        return result, model_config
+
+    async def call(self, model_config: Dict[str, str],
+                   call: Callable[[Dict[str, str]], Awaitable[Any]]) -> Tuple[Any, Dict[str, str]]:
+        """Run a provider call, failing over (and optionally hedging) across equivalent models.
+
+        Returns the result and the config of the model that served it.
+        """
+        candidates = self.candidates(model_config)
+        if self.hedge:
+            return await self._hedged(candidates, call)
+        
+        last_error = None
+        for candidate in candidates:
+            try:
+                return await self._attempt(candidate, call)
+            except Exception as e:
+                if not is_retriable_error(e):
+                    raise
+                last_error = e
+                if candidate is not candidates[-1]:
+                    self.failovers += 1
+                    logger.warning(f"{self.model_key(candidate)} failed, failing over: {str(e)}")
+        raise last_error
+
+    async def _hedged(self, candidates: List[Dict[str, str]],
+                      call: Callable[[Dict[str, str]], Awaitable[Any]]) -> Tuple[Any, Dict[str, str]]:
+        # Hedge on the same model when it has no healthy equivalent
+        backups = candidates[1:] or candidates[:1]
+        delay = self.hedge_delay(candidates[0])
+        pending = {asyncio.ensure_future(self._attempt(candidates[0], call))}
+        last_error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=delay if backups else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                    if not is_retriable_error(last_error):
+                        raise last_error
+                
+                if backups and (not done or not pending):
+                    if done:
+                        self.failovers += 1
+                    else:
+                        self.hedges += 1
+                    pending.add(asyncio.ensure_future(self._attempt(backups.pop(0), call)))
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, model_config: Dict[str, str],
+                     open_stream: Callable[[Dict[str, str]], AsyncIterator[str]]) -> AsyncIterator[Tuple[str, Dict[str, str]]]:
+        """Stream (delta, serving model config) pairs from the first healthy model.
+
+        Fails over only before the first delta.
+        """
+        last_error = None
+        for candidate in self.candidates(model_config):
+            stats = self.stats_for(candidate)
+            if stats.state == "half_open":
+                stats.probe_in_flight = True
+            started = False
+            try:
+                async for text in open_stream(candidate):
+                    started = True
+                    yield text, candidate
+            except Exception as e:
+                if is_retriable_error(e):
+                    self.record(candidate, False)
+                else:
+                    stats.probe_in_flight = False
+                if started or not is_retriable_error(e):
+                    raise
+                last_error = e
+                self.failovers += 1
+                logger.warning(f"{self.model_key(candidate)} stream failed, failing over: {str(e)}")
+                continue
+            finally:
+                # Also runs on cancellation or a consumer closing the stream
+                # (neither is an Exception), which must not strand the probe
+                if stats.state == "half_open":
+                    stats.probe_in_flight = False
+            self.record(candidate, True)
+            return
+        raise last_error
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-model routing state for the health endpoint"""
+        now = time.time()
+        models = {}
+        for key, stats in self._stats.items():
+            stats.trim(now, ROUTER_WINDOW_SECONDS)
+            p50 = stats.latency_percentile(0.5)
+            p95 = stats.latency_percentile(0.95)
+            models[key] = {
+                "state": stats.state,
+                "requests": len(stats.samples),
+                "error_rate": round(stats.error_rate(), 4),
+                "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None
+            }
+        return {
+            "failover_enabled": self.failover,
+            "hedge_enabled": self.hedge,
+            "failovers": self.failovers,
+            "hedges": self.hedges,
+            "models": models
+        }
+
+def provider_configured(provider: str) -> bool:
+    """Whether an async client exists for the provider"""
+    return {"anthropic": async_anthropic_client, "openai": async_openai_client}.get(provider) is not None
+
+provider_router = ProviderRouter(
+    equivalents=MODEL_EQUIVALENTS,
+    is_configured=provider_configured,
+    failover=ROUTER_FAILOVER_ENABLED,
+    hedge=ROUTER_HEDGE_ENABLED
+)
+
+# Vector index configuration
+VECTOR_STORE_DIR = os.getenv("VECTOR_STORE_DIR")  # memory only when unset
+VECTOR_SEARCH_CHUNK_ROWS = int(os.getenv("VECTOR_SEARCH_CHUNK_ROWS", "65536"))
+VECTOR_IVF_LISTS = int(os.getenv("VECTOR_IVF_LISTS", "0"))  # 0 disables IVF partitioning
+VECTOR_IVF_PROBES = int(os.getenv("VECTOR_IVF_PROBES", "8"))
+VECTOR_IVF_MIN_ROWS = int(os.getenv("VECTOR_IVF_MIN_ROWS", "50000"))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_BATCH_SIZE = 512  # inputs per embeddings call
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize rows so cosine similarity is a dot product"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+class VectorIndex:
+    """Cosine-similarity index over a float32 embedding matrix with metadata.
+
+    Vectors are normalized on upsert, so a search is one matrix product per
+    row chunk followed by argpartition, computed for a whole batch of queries
+    at once. With a store directory the matrix is a memory-mapped file next to
+    a JSON-lines metadata sidecar; upserts write under a file lock and other
+    workers pick them up on their next search. With IVF enabled, large indexes
+    are partitioned by spherical k-means and queries scan only the nearest
+    lists.
+    """
+
+    VECTORS_FILE = "vectors.f32"
+    METADATA_FILE = "metadata.jsonl"
+    MANIFEST_FILE = "index.json"
+
+    def __init__(self, store_dir: Optional[str] = None, chunk_rows: int = 65536,
+                 ivf_lists: int = 0, ivf_probes: int = 8, ivf_min_rows: int = 50000):
+        self.store_dir = store_dir
+        self.chunk_rows = chunk_rows
+        self.ivf_lists = ivf_lists
+        self.ivf_probes = ivf_probes
+        self.ivf_min_rows = ivf_min_rows
+        self.dimension: Optional[int] = None
+        self.ids: List[str] = []
+        self.metadata: List[Dict[str, Any]] = []
+        self.rows: Dict[str, int] = {}
+        self.searches = 0
+        self.upserts = 0
+        self._matrix: Optional[np.ndarray] = None  # growable buffer, or memmap of the store
+        self._metadata_offset = 0  # sidecar bytes already loaded
+        self._centroids: Optional[np.ndarray] = None
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._list_rows: List[np.ndarray] = []  # row ids per IVF list
+        self._ivf_built_rows = 0
+        self._updated_rows: set = set()  # replaced rows whose IVF list may be stale
+        self._lock = threading.Lock()
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+            self._refresh()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.store_dir, name)
+
+    @contextmanager
+    def _store_lock(self):
+        """Serialize writers across worker processes"""
+        if not self.store_dir:
+            yield
+            return
+        with open(self._path(".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Load sidecar entries appended by any worker and remap the matrix"""
+        try:
+            size = os.path.getsize(self._path(self.METADATA_FILE))
+        except FileNotFoundError:
+            return
+        if size == self._metadata_offset:
+            return
+        
+        if self.dimension is None:
+            with open(self._path(self.MANIFEST_FILE), "rb") as f:
+                self.dimension = orjson.loads(f.read())["dimension"]
+        with open(self._path(self.METADATA_FILE), "rb") as f:
+            f.seek(self._metadata_offset)
+            data = f.read()
+        # Only consume complete lines; a concurrent writer may be mid-append
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            entry = orjson.loads(line)
+            self._apply(entry["row"], entry["id"], entry["metadata"])
+        self._metadata_offset += end
+        self._matrix = np.memmap(
+            self._path(self.VECTORS_FILE), dtype=np.float32, mode="r", shape=(len(self.ids), self.dimension)
+        )
+
+    def _apply(self, row: int, doc_id: str, metadata: Dict[str, Any]):
+        if row == len(self.ids):
+            self.ids.append(doc_id)
+            self.metadata.append(metadata)
+        else:
+            self.metadata[row] = metadata
+            self._updated_rows.add(row)
+        self.rows[doc_id] = row
+
+    def upsert(self, ids: List[str], vectors: np.ndarray, metadata: List[Dict[str, Any]]) -> Dict[str, int]:
+        """Insert or replace documents by id"""
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        # The last occurrence of a repeated id wins
+        latest = {doc_id: i for i, doc_id in enumerate(ids)}
+        
+        with self._lock, self._store_lock():
+            if self.store_dir:
+                self._refresh()
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+                if self.store_dir:
+                    with open(self._path(self.MANIFEST_FILE), "wb") as f:
+                        f.write(orjson.dumps({"dimension": self.dimension}))
+            if vectors.shape[1] != self.dimension:
+                raise ValueError(f"Vector dimension {vectors.shape[1]} does not match index dimension {self.dimension}")
+            
+            entries = []
+            next_row = len(self.ids)
+            for doc_id, i in latest.items():
+                row = self.rows.get(doc_id)
+                if row is None:
+                    row, next_row = next_row, next_row + 1
+                entries.append((row, doc_id, i))
+            inserted = next_row - len(self.ids)
+            
+            if self.store_dir:
+                self._write_store(entries, vectors, metadata)
+                self._refresh()
+            else:
+                self._write_memory(entries, vectors, metadata, next_row)
+            
+            self.upserts += len(entries)
+        return {"inserted": inserted, "updated": len(entries) - inserted, "count": len(self.ids)}
+
+    def _write_store(self, entries: List[tuple], vectors: np.ndarray, metadata: List[Dict[str, Any]]):
+        # Vectors are written before the sidecar lines that make them visible
+        mode = "r+b" if os.path.exists(self._path(self.VECTORS_FILE)) else "w+b"
+        row_bytes = self.dimension * 4
+        with open(self._path(self.VECTORS_FILE), mode) as f:
+            for row, _, i in entries:
+                f.seek(row * row_bytes)
+                f.write(vectors[i].tobytes())
+        lines = b"".join(
+            orjson.dumps({"row": row, "id": doc_id, "metadata": metadata[i]}) + b"\n"
+            for row, doc_id, i in entries
+        )
+        with open(self._path(self.METADATA_FILE), "ab") as f:
+            f.write(lines)
+
+    def _write_memory(self, entries: List[tuple], vectors: np.ndarray, metadata: List[Dict[str, Any]], rows: int):
+        capacity = 0 if self._matrix is None else len(self._matrix)
+        if rows > capacity:
+            grown = np.zeros((max(rows, capacity * 2, 1024), self.dimension), dtype=np.float32)
+            if capacity:
+                grown[:len(self.ids)] = self._matrix[:len(self.ids)]
+            self._matrix = grown
+        for row, doc_id, i in sorted(entries):
+            self._matrix[row] = vectors[i]
+            self._apply(row, doc_id, metadata[i])
+
+    def _update_ivf(self):
+        """Keep IVF lists current: assign appended and replaced rows, rebuild when the index doubles"""
+        count = len(self.ids)
+        updated, self._updated_rows = self._updated_rows, set()
+        if not self.ivf_lists or count < max(self.ivf_min_rows, self.ivf_lists):
+            return
+        matrix = self._matrix[:count]
+        if self._centroids is None or count > 2 * self._ivf_built_rows:
+            self._centroids = self._kmeans(matrix)
+            self._ivf_built_rows = count
+            start = 0
+        else:
+            start = len(self._assignments)
+        # Rows from start on are assigned below along with the appended rows
+        updated = np.fromiter((row for row in updated if row < start), dtype=np.int64)
+        if start == count and not len(updated):
+            return
+        assignments = [self._assignments[:start]]
+        for chunk_start in range(start, count, self.chunk_rows):
+            chunk = matrix[chunk_start:chunk_start + self.chunk_rows]
+            assignments.append(np.argmax(chunk @ self._centroids.T, axis=1).astype(np.int32))
+        self._assignments = np.concatenate(assignments)
+        if len(updated):
+            self._assignments[updated] = np.argmax(matrix[updated] @ self._centroids.T, axis=1)
+        order = np.argsort(self._assignments, kind="stable")
+        bounds = np.searchsorted(self._assignments[order], np.arange(self.ivf_lists + 1))
+        self._list_rows = [order[bounds[i]:bounds[i + 1]] for i in range(self.ivf_lists)]
+
+    def _kmeans(self, matrix: np.ndarray, iterations: int = 8) -> np.ndarray:
+        rng = np.random.default_rng(0)
+        sample_size = min(len(matrix), self.ivf_lists * 64)
+        sample = np.asarray(matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))])
+        centroids = sample[rng.choice(sample_size, self.ivf_lists, replace=False)]
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            # Empty lists keep their previous centroid
+            filled = np.bincount(labels, minlength=self.ivf_lists) > 0
+            centroids[filled] = normalize_rows(sums[filled])
+        return centroids
+
+    def search(self, queries: np.ndarray, top_k: int) -> List[List[Dict[str, Any]]]:
+        """Top-k matches for each query vector, best first"""
+        with self._lock:
+            if self.store_dir:
+                self._refresh()
+            self._update_ivf()
+            count = len(self.ids)
+            matrix = self._matrix[:count] if count else None
+            ids, metadata = self.ids, self.metadata
+            centroids, list_rows = self._centroids, self._list_rows
+        
+        queries = normalize_rows(np.asarray(queries, dtype=np.float32))
+        if matrix is None:
+            return [[] for _ in queries]
+        if queries.shape[1] != self.dimension:
+            raise ValueError(f"Query dimension {queries.shape[1]} does not match index dimension {self.dimension}")
+        self.searches += len(queries)
+        
+        top_k = min(top_k, count)
+        if centroids is not None:
+            rows, scores = self._ivf_search(matrix, queries, top_k, centroids, list_rows)
+        else:
+            rows, scores = self._exact_search(matrix, queries, top_k)
+        return [
+            [
+                {"id": ids[row], "score": round(float(score), 6), "metadata": metadata[row]}
+                for row, score in zip(query_rows, query_scores) if row >= 0
+            ]
+            for query_rows, query_scores in zip(rows, scores)
+        ]
+
+    def _exact_search(self, matrix: np.ndarray, queries: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(matrix), self.chunk_rows):
+            scores = queries @ matrix[start:start + self.chunk_rows].T
+            k = min(top_k, scores.shape[1])
+            rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_rows = np.concatenate([best_rows, rows + start], axis=1)
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, rows, axis=1)], axis=1)
+            if best_rows.shape[1] > top_k:
+                keep = np.argpartition(-best_scores, top_k - 1, axis=1)[:, :top_k]
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def _ivf_search(self, matrix: np.ndarray, queries: np.ndarray, top_k: int,
+                    centroids: np.ndarray, list_rows: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        probes = min(self.ivf_probes, len(centroids))
+        nearest_lists = np.argpartition(-(queries @ centroids.T), probes - 1, axis=1)[:, :probes]
+        all_rows = np.full((len(queries), top_k), -1, dtype=np.int64)
+        all_scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+        for q, lists in enumerate(nearest_lists):
+            candidates = np.concatenate([list_rows[i] for i in lists])
+            if not len(candidates):
+                continue
+            scores = matrix[candidates] @ queries[q]
+            k = min(top_k, len(candidates))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            all_rows[q, :k] = candidates[top]
+            all_scores[q, :k] = scores[top]
+        return all_rows, all_scores
+
+    def stats(self) -> Dict[str, Any]:
+        """Index size and counters for the health endpoint"""
+        return {
+            "documents": len(self.ids),
+            "dimension": self.dimension,
+            "persistent": bool(self.store_dir),
+            "ivf_lists": 0 if self._centroids is None else len(self._centroids),
+            "searches": self.searches,
+            "upserts": self.upserts
+        }
+
+vector_index = VectorIndex(
+    store_dir=VECTOR_STORE_DIR,
+    chunk_rows=VECTOR_SEARCH_CHUNK_ROWS,
+    ivf_lists=VECTOR_IVF_LISTS,
+    ivf_probes=VECTOR_IVF_PROBES,
+    ivf_min_rows=VECTOR_IVF_MIN_ROWS
+)
+
+async def embed_texts(texts: List[str]) -> np.ndarray:
+    """Embed texts with the OpenAI embeddings API, batched"""
+    if not provider_configured("openai"):
+        raise HTTPException(status_code=400, detail="Embedding text requires OPENAI_API_KEY; send vectors instead")
+    
+    model_config = {"provider": "openai", "model_id": EMBEDDING_MODEL}
+
+    async def embed_batch(batch: List[str]) -> List[List[float]]:
+        started = time.perf_counter()
+        try:
+            async with provider_slot("openai"):
+                result = await async_openai_client.embeddings.create(model=EMBEDDING_MODEL, input=batch)
+        except Exception as e:
+            record_provider_call(model_config, started, "error")
+            logger.error(f"Error embedding texts: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Embedding failed: {str(e)}")
+        record_provider_call(model_config, started, "ok", input_tokens=result.usage.prompt_tokens)
+        return [item.embedding for item in sorted(result.data, key=lambda item: item.index)]
+
+    batches = await asyncio.gather(*(
+        embed_batch(texts[i:i + EMBEDDING_BATCH_SIZE]) for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)
+    ))
+    return np.asarray([vector for batch in batches for vector in batch], dtype=np.float32)
+
+# Admission control configuration
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "256"))
+ADMISSION_QUEUE_DEADLINE_SECONDS = float(os.getenv("ADMISSION_QUEUE_DEADLINE_SECONDS", "10"))
+TENANT_REQUESTS_PER_MINUTE = float(os.getenv("TENANT_REQUESTS_PER_MINUTE", "0"))  # 0 means unlimited
+TENANT_TOKENS_PER_MINUTE = float(os.getenv("TENANT_TOKENS_PER_MINUTE", "0"))
+PROVIDER_BUDGETS = {
+    provider: (
+        float(os.getenv(f"{provider.upper()}_REQUESTS_PER_MINUTE", "0")),
+        float(os.getenv(f"{provider.upper()}_TOKENS_PER_MINUTE", "0"))
+    )
+    for provider in ("anthropic", "openai")
+}
+DEFAULT_MAX_TOKENS = int(os.getenv("DEFAULT_MAX_TOKENS", "1000"))
+MAX_TOKENS_LIMIT = int(os.getenv("MAX_TOKENS_LIMIT", "4096"))
+DEFAULT_TENANT = "default"
+
+# Lower rank is admitted first
+PRIORITY_CLASSES = {"interactive": 0, "batch": 1}
+
+class TokenBucket:
+    """Rate budget refilled continuously; the level may go negative to queue reservations"""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount fits in the budget"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def refund(self, amount: float, now: float):
+        """Return a reservation that was never used"""
+        self._refill(now)
+        self.level = min(self.capacity, self.level + min(amount, self.capacity))
+
+class AdmissionController:
+    """Priority admission queue with per-tenant and per-provider rate budgets.
+
+    Requests reserve request and token budget up front and wait in a priority
+    queue for one of max_concurrent slots. When the expected wait exceeds the
+    queue deadline the request is rejected immediately with a 429 and a
+    Retry-After hint instead of timing out against the provider. A request
+    that is rejected or cancelled while queued gets its reservation back.
+    """
+
+    MAX_TENANTS = 10000
+
+    def __init__(self, max_concurrent: int, deadline_seconds: float, enabled: bool = True):
+        self.enabled = enabled
+        self.max_concurrent = max_concurrent
+        self.deadline_seconds = deadline_seconds
+        self.admitted = 0
+        self.rejected = 0
+        self._active = 0
+        self._waiters: List[tuple] = []  # (rank, seq, future)
+        self._seq = itertools.count()
+        self._service_time = 1.0  # EWMA of seconds a slot is held
+        self._tenant_buckets: "OrderedDict[str, tuple]" = OrderedDict()
+        self._provider_buckets = {
+            provider: (
+                TokenBucket(requests) if requests > 0 else None,
+                TokenBucket(tokens) if tokens > 0 else None
+            )
+            for provider, (requests, tokens) in PROVIDER_BUDGETS.items()
+        }
+
+    def _tenant(self, tenant: str) -> tuple:
+        buckets = self._tenant_buckets.get(tenant)
+        if buckets is None:
+            buckets = (
+                TokenBucket(TENANT_REQUESTS_PER_MINUTE) if TENANT_REQUESTS_PER_MINUTE > 0 else None,
+                TokenBucket(TENANT_TOKENS_PER_MINUTE) if TENANT_TOKENS_PER_MINUTE > 0 else None
+            )
+            self._tenant_buckets[tenant] = buckets
+            if len(self._tenant_buckets) > self.MAX_TENANTS:
+                self._tenant_buckets.popitem(last=False)
+        self._tenant_buckets.move_to_end(tenant)
+        return buckets
+
+    def _budgets(self, tenant: str, provider: str, tokens: int) -> List[tuple]:
+        requests_bucket, tokens_bucket = self._tenant(tenant)
+        provider_requests, provider_tokens = self._provider_buckets.get(provider, (None, None))
+        budgets = [(requests_bucket, 1), (tokens_bucket, tokens), (provider_requests, 1), (provider_tokens, tokens)]
+        return [(bucket, amount) for bucket, amount in budgets if bucket is not None]
+
+    def _queue_wait(self, rank: int) -> float:
+        if self._active < self.max_concurrent:
+            return 0.0
+        ahead = sum(1 for waiter_rank, _, future in self._waiters if waiter_rank <= rank and not future.done())
+        return (ahead + 1) / self.max_concurrent * self._service_time
+
+    def _reject(self, retry_after: float, reason: str) -> HTTPException:
+        self.rejected += 1
+        return HTTPException(
+            status_code=429,
+            detail=f"Request rejected by admission control: {reason}",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+    async def acquire(self, tenant: str, provider: str, priority: str, tokens: int) -> float:
+        """Wait for budget and a slot; returns the admission time to pass to release"""
+        if not self.enabled:
+            return time.perf_counter()
+        
+        rank = PRIORITY_CLASSES[priority]
+        now = time.monotonic()
+        budgets = self._budgets(tenant, provider, tokens)
+        budget_wait = max((bucket.wait_time(amount, now) for bucket, amount in budgets), default=0.0)
+        expected_wait = budget_wait + self._queue_wait(rank)
+        if expected_wait > self.deadline_seconds:
+            reason = "rate budget exhausted" if budget_wait > 0 else "queue is full"
+            raise self._reject(expected_wait, reason)
+        
+        for bucket, amount in budgets:
+            bucket.consume(amount, now)
+        try:
+            if budget_wait > 0:
+                await asyncio.sleep(budget_wait)
+            await self._take_slot(rank, budget_wait)
+        except BaseException:
+            refunded_at = time.monotonic()
+            for bucket, amount in budgets:
+                bucket.refund(amount, refunded_at)
+            raise
+        
+        self.admitted += 1
+        return time.perf_counter()
+
+    async def _take_slot(self, rank: int, budget_wait: float):
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (rank, next(self._seq), future))
+        try:
+            await asyncio.wait_for(future, timeout=max(self.deadline_seconds - budget_wait, 0.001))
+        except asyncio.TimeoutError:
+            raise self._reject(self._service_time, "queue deadline exceeded")
+        except asyncio.CancelledError:
+            # A slot handed over just before cancellation must not leak
+            if future.done() and not future.cancelled():
+                self._hand_over()
+            raise
+
+    def release(self, admitted_at: float):
+        """Free a slot, handing it to the highest-priority waiter"""
+        if not self.enabled:
+            return
+        self._service_time = 0.8 * self._service_time + 0.2 * (time.perf_counter() - admitted_at)
+        self._hand_over()
+
+    def _hand_over(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def admit(self, tenant: str, provider: str, priority: str, tokens: int):
+        admitted_at = await self.acquire(tenant, provider, priority, tokens)
+        try:
+            yield
+        finally:
+            self.release(admitted_at)
+
+    def stats(self) -> Dict[str, Any]:
+        """Admission counters for the health endpoint"""
+        return {
+            "enabled": self.enabled,
+            "active": self._active,
+            "queued": sum(1 for _, _, future in self._waiters if not future.done()),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_service_seconds": round(self._service_time, 3)
+        }
+
+admission_controller = AdmissionController(
+    max_concurrent=ADMISSION_MAX_CONCURRENT,
+    deadline_seconds=ADMISSION_QUEUE_DEADLINE_SECONDS,
+    enabled=ADMISSION_ENABLED
+)
 
 # Pydantic models for request/response
 class ChatRequest(BaseModel):
@@ -106,11 +1957,17 @@ class ChatRequest(BaseModel):
     session_id: Optional[str] = None
     model_provider: str = "anthropic"  # "anthropic" or "openai"
     model_name: Optional[str] = None
-    context: Optional[Dict[str, Any]] = None
+    context: Optional[Union[str, Dict[str, Any]]] = None  # inline context or a context_id from PUT /api/context
+    use_cache: Optional[bool] = None  # default: cache only low-temperature calls; false bypasses the cache
+    agent_id: Optional[str] = None  # chat with a registered agent instead of the generic one
+    max_tokens: Optional[int] = Field(default=None, ge=1)  # defaults to DEFAULT_MAX_TOKENS
+    priority: Optional[str] = None  # "interactive" (default) or "batch"
+    tenant_id: Optional[str] = None  # budget key for per-tenant rate limits
+    response_schema: Optional[Dict[str, Any]] = None  # JSON Schema the response must validate against
 
 class ChatResponse(BaseModel):
     """Response from a chat request"""
-    response: Union[str, dict]
+    response: Union[str, dict, list]
     session_id: Optional[str] = None
     model_used: Optional[str] = None
     timestamp: Optional[datetime] = Field(default_factory=lambda: datetime.now())
@@ -120,6 +1977,57 @@ class ChatResponse(BaseModel):
             datetime: lambda v: v.isoformat()
         }
 
+class BatchChatRequest(BaseModel):
+    """A set of independent chat requests served in one round trip"""
+    requests: List[ChatRequest]
+    max_concurrency: Optional[int] = None
+
+class BatchChatItem(BaseModel):
+    """Result of one request within a batch"""
+    index: int
+    ok: bool
+    result: Optional[ChatResponse] = None
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+
+class PipelineStep(BaseModel):
+    """One agent call in a pipeline.
+
+    The message is a template: {{input}} / {{input.field}} refer to the
+    pipeline input and {{steps.<id>}} / {{steps.<id>.field}} to the response
+    of an earlier step. Referenced steps are implicit dependencies.
+    """
+    id: str
+    message: str
+    depends_on: List[str] = Field(default_factory=list)
+    agent_id: Optional[str] = None
+    instructions: Optional[str] = None
+    model_provider: str = "anthropic"
+    model_name: Optional[str] = None
+    temperature: float = 0.7
+    context: Optional[Union[str, Dict[str, Any]]] = None
+    use_cache: Optional[bool] = None
+    max_tokens: Optional[int] = Field(default=None, ge=1)
+    priority: Optional[str] = None
+    response_schema: Optional[Dict[str, Any]] = None
+
+class PipelineRequest(BaseModel):
+    """A DAG of agent steps executed server-side in one round trip"""
+    steps: List[PipelineStep]
+    input: Optional[Any] = None
+    max_concurrency: Optional[int] = None
+    tenant_id: Optional[str] = None
+
+class PipelineStepResult(BaseModel):
+    """Outcome of one pipeline step"""
+    id: str
+    ok: bool
+    response: Optional[Union[str, dict, list]] = None
+    model_used: Optional[str] = None
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+    elapsed_ms: float = 0.0
+
 class AgentConfig(BaseModel):
     name: str
     instructions: str
@@ -128,13 +2036,74 @@ class AgentConfig(BaseModel):
     temperature: float = 0.1
     markdown: bool = True
 
-# Global agent registry
-agents = {}
+class RagDocument(BaseModel):
+    """A document to index; text is embedded unless a vector is supplied"""
+    id: str = Field(min_length=1, max_length=512)
+    text: Optional[str] = None
+    vector: Optional[List[float]] = None
+    metadata: Dict[str, Any] = Field(default_factory=dict)
+
+class RagUpsertRequest(BaseModel):
+    documents: List[RagDocument]
+
+class RagSearchRequest(BaseModel):
+    """Batched retrieval without answer generation"""
+    queries: Optional[List[str]] = None
+    vectors: Optional[List[List[float]]] = None
+    top_k: int = 5
+
+class RagQueryRequest(BaseModel):
+    """Retrieve passages for a question and answer it in one call"""
+    query: str
+    vector: Optional[List[float]] = None  # precomputed query embedding
+    top_k: int = 5
+    min_score: Optional[float] = None
+    instructions: Optional[str] = None
+    model_provider: str = "anthropic"
+    model_name: Optional[str] = None
+    temperature: float = 0.7
+    session_id: Optional[str] = None
+    use_cache: Optional[bool] = None
+    max_tokens: Optional[int] = Field(default=None, ge=1)
+    priority: Optional[str] = None
+    tenant_id: Optional[str] = None
+
+class RagQueryResponse(BaseModel):
+    """Formatted answer plus the raw answer and matched sources"""
+    response: str
+    answer: Union[str, dict, list]
+    sources: List[Dict[str, Any]]
+    session_id: Optional[str] = None
+    model_used: Optional[str] = None
+    timestamp: Optional[datetime] = Field(default_factory=lambda: datetime.now())
+
+# Instructions for the generic agent behind /api/agent/chat
+DEFAULT_CHAT_INSTRUCTIONS = "You are a helpful AI assistant. Please provide clear and concise responses."
 
+# Instructions for the agent behind /api/rag/query
+RAG_INSTRUCTIONS = (
+    "You answer questions using the numbered passages provided with each question. "
+    "Cite passages by number, e.g. [1]. If the passages do not contain the answer, say so."
+)
+
+# Retrieval limits
+RAG_MAX_TOP_K = int(os.getenv("RAG_MAX_TOP_K", "50"))
+RAG_MAX_QUERIES = int(os.getenv("RAG_MAX_QUERIES", "64"))
+RAG_MAX_UPSERT_DOCUMENTS = int(os.getenv("RAG_MAX_UPSERT_DOCUMENTS", "1000"))
+
+# Batch chat limits
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+
+# Pipeline limits
+PIPELINE_MAX_CONCURRENCY = int(os.getenv("PIPELINE_MAX_CONCURRENCY", "8"))
+PIPELINE_MAX_STEPS = int(os.getenv("PIPELINE_MAX_STEPS", "32"))
+
+@lru_cache(maxsize=64)
 def get_model_config(provider: str, model_name: Optional[str] = None):
     """Get model configuration based on provider preference"""
     if provider.lower() == "anthropic":
-        if not anthropic_client:
+        if not provider_configured("anthropic"):
             raise HTTPException(status_code=500, detail="ANTHROPIC_API_KEY not configured")
         
         # For latest Anthropic API, use the correct model names
@@ -167,7 +2136,7 @@ def get_model_config(provider: str, model_name: Optional[str] = None):
         }
     
     elif provider.lower() == "openai":
-        if not openai_client:
+        if not provider_configured("openai"):
             raise HTTPException(status_code=500, detail="OPENAI_API_KEY not configured")
         
         default_model = "gpt-4-turbo-preview"
@@ -190,49 +2159,250 @@ def get_model_config(provider: str, model_name: Optional[str] = None):
     else:
         raise HTTPException(status_code=400, detail=f"Unsupported model provider: {provider}")
 
+# Appended to every system prompt so JSON answers come back without markdown
+JSON_OUTPUT_INSTRUCTION = "\n\nIMPORTANT: If the user asks for JSON output, return ONLY the JSON object without any markdown formatting, code blocks, or additional text."
+
 class Agent:
-    def __init__(self, instructions: str, model_config: dict, temperature: float = 0.7):
+    def __init__(self, instructions: str, model_config: dict, temperature: float = 0.7, name: Optional[str] = None):
         """Initialize an agent with instructions and model configuration"""
+        self.name = name
         self.instructions = instructions
         self.model_config = model_config
         self.temperature = temperature
+        
+        # Everything that does not depend on the message is computed once per agent
+        self.system_instruction = f"{instructions}{JSON_OUTPUT_INSTRUCTION}"
+        self.system_tokens = estimate_tokens(self.system_instruction)
+        self.openai_system_message = {"role": "system", "content": self.system_instruction}
+        self.request_template = {
+            "model": model_config["model_id"],
+            "max_tokens": DEFAULT_MAX_TOKENS,
+            "temperature": temperature
+        }
     
-    def chat(self, message: str) -> str:
-        """Send a message to the agent and get a response"""
+    def _request_key(self, messages: List[Dict[str, Any]], max_tokens: int) -> str:
+        return response_cache.make_key(
+            self.model_config["provider"], self.model_config["model_id"],
+            self.system_instruction, messages, self.temperature, max_tokens
+        )
+
+    def estimate_request_tokens(self, messages: List[Dict[str, Any]], max_tokens: int) -> int:
+        """Upper estimate of the tokens a call will use, for rate budgets"""
+        return self.system_tokens + sum(estimate_tokens(m["content"]) for m in messages) + max_tokens
+
+    def _anthropic_params(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """System prompt and messages for Anthropic, marking the stable prefix for prompt caching"""
+        params = {"system": self.system_instruction, "messages": messages}
+        if not PROMPT_CACHING_ENABLED:
+            return params
+        
+        cached = False
+        if self.system_tokens >= PROMPT_CACHE_MIN_TOKENS:
+            params["system"] = [{
+                "type": "text",
+                "text": self.system_instruction,
+                "cache_control": {"type": "ephemeral"}
+            }]
+            cached = True
+        
+        # The session history ends with the previous assistant turn
+        if len(messages) > 1:
+            history_tokens = sum(estimate_tokens(m["content"]) for m in messages[:-1])
+            if self.system_tokens + history_tokens >= PROMPT_CACHE_MIN_TOKENS:
+                last = messages[-2]
+                params["messages"] = messages[:-2] + [{
+                    "role": last["role"],
+                    "content": [{"type": "text", "text": last["content"], "cache_control": {"type": "ephemeral"}}]
+                }, messages[-1]]
+                cached = True
+        
+        if cached:
+            params["extra_headers"] = {"anthropic-beta": ANTHROPIC_PROMPT_CACHING_BETA}
+        return params
+
+    async def achat(self, message: str, use_cache: Optional[bool] = None,
+                    history: Optional[List[Dict[str, str]]] = None,
+                    max_tokens: Optional[int] = None,
+                    tenant: str = DEFAULT_TENANT, priority: str = "interactive") -> Tuple[Union[str, dict], str]:
+        """Send a message to the agent without blocking the event loop.
+
+        Returns the response and the "provider:model_id" that served it, which
+        differs from the agent's model after a failover or a winning hedge.
+        """
+        messages = (history or []) + [{"role": "user", "content": message}]
+        max_tokens = max_tokens or DEFAULT_MAX_TOKENS
+        key = self._request_key(messages, max_tokens)
+        if use_cache is None:
+            # Sampled answers are not frozen unless the caller opts in
+            use_cache = self.temperature <= RESPONSE_CACHE_MAX_TEMPERATURE
+        use_cache = use_cache and response_cache.enabled
+        
+        if use_cache:
+            with timed_stage("cache"):
+                cached = await response_cache.get(key)
+            if cached is not None:
+                response, model_used = cached
+                return response, model_used
+        
+        # Identical concurrent requests from the same tenant and priority wait
+        # on a single provider call, and only that call is charged to admission
+        # control. Tenant and priority stay out of the response cache key.
+        return await request_coalescer.run(
+            f"{key}:{tenant}:{priority}",
+            lambda: self._complete(messages, key, max_tokens, use_cache, tenant, priority)
+        )
+
+    async def _complete(self, messages: List[Dict[str, Any]], key: str, max_tokens: int,
+                        use_cache: bool, tenant: str, priority: str) -> Tuple[Union[str, dict], str]:
+        with timed_stage("admission"):
+            admitted_at = await admission_controller.acquire(
+                tenant, self.model_config["provider"], priority,
+                self.estimate_request_tokens(messages, max_tokens)
+            )
         try:
-            if self.model_config["provider"] == "anthropic":
-                # For latest Anthropic API, use messages endpoint
-                # Add instruction to return clean JSON without markdown
-                system_instruction = f"{self.instructions}\n\nIMPORTANT: If the user asks for JSON output, return ONLY the JSON object without any markdown formatting, code blocks, or additional text."
-                
-                response = anthropic_client.messages.create(
-                    model=self.model_config["model_id"],
-                    max_tokens=1000,
-                    temperature=self.temperature,
-                    system=system_instruction,
-                    messages=[
-                        {"role": "user", "content": message}
-                    ]
+            text, served_by = await provider_router.call(
+                self.model_config,
+                lambda model_config: self._provider_call(model_config, messages, max_tokens)
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            if getattr(e, "status_code", None) == 429:
+                # Surface provider rate limiting as backpressure rather than a server error
+                retry_after = e.response.headers.get("retry-after", "1") if getattr(e, "response", None) is not None else "1"
+                raise HTTPException(
+                    status_code=429,
+                    detail=f"Provider rate limited: {str(e)}",
+                    headers={"Retry-After": retry_after}
                 )
-                return clean_json_response(response.content[0].text)
+            logger.error(f"Error in agent chat: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Chat failed: {str(e)}")
+        finally:
+            admission_controller.release(admitted_at)
+        
+        with timed_stage("parse"):
+            result = clean_json_response(text)
+        model_used = provider_router.model_key(served_by)
+        if use_cache:
+            # Stored under the requested model's key even when an equivalent served it
+            await response_cache.set(key, [result, model_used])
+        return result, model_used
+
+    async def conform(self, message: str, response: Any, model_used: str, validator,
+                      history: Optional[List[Dict[str, str]]] = None, **kwargs) -> Tuple[Any, str]:
+        """Validate a structured response, asking the model to repair it if needed.
+
+        Returns the valid value and the model that produced it.
+        """
+        history = history or []
+        for attempt in range(STRUCTURED_OUTPUT_MAX_REPAIRS + 1):
+            with timed_stage("validate"):
+                value, errors = validate_output(response, validator)
+            if not errors:
+                return value, model_used
+            if attempt == STRUCTURED_OUTPUT_MAX_REPAIRS:
+                break
             
-            else:  # openai
-                # Add instruction to return clean JSON without markdown
-                system_instruction = f"{self.instructions}\n\nIMPORTANT: If the user asks for JSON output, return ONLY the JSON object without any markdown formatting, code blocks, or additional text."
-                response = openai_client.chat.completions.create(
-                    model=self.model_config["model_id"],
-                    max_tokens=1000,
-                    temperature=self.temperature,
-                    messages=[
-                        {"role": "system", "content": system_instruction},
-                        {"role": "user", "content": message}
-                    ]
-                )
-                return clean_json_response(response.choices[0].message.content)
+            # The repair turn carries only the errors; the earlier exchange is
+            # resent as (prompt-cached) history rather than a fresh request
+            logger.info(f"Structured output failed validation, repairing: {errors[0]}")
+            assistant = response if isinstance(response, str) else orjson.dumps(response).decode()
+            history = history + [{"role": "user", "content": message}, {"role": "assistant", "content": assistant}]
+            message = (
+                "Your JSON did not validate against the schema:\n- " + "\n- ".join(errors) +
+                "\nReply with only the corrected JSON."
+            )
+            response, model_used = await self.achat(message, history=history, **kwargs)
+        
+        raise HTTPException(
+            status_code=422,
+            detail=f"Response did not match response_schema: {'; '.join(errors)}"
+        )
+
+    def _params_for(self, model_config: Dict[str, str], max_tokens: int) -> Dict[str, Any]:
+        if model_config["model_id"] == self.request_template["model"] and max_tokens == self.request_template["max_tokens"]:
+            return self.request_template
+        return {**self.request_template, "model": model_config["model_id"], "max_tokens": max_tokens}
+
+    async def _provider_call(self, model_config: Dict[str, str], messages: List[Dict[str, Any]], max_tokens: int) -> str:
+        """One completion against a specific provider model"""
+        async with provider_slot(model_config["provider"]):
+            started = time.perf_counter()
+            try:
+                if model_config["provider"] == "anthropic":
+                    response = await async_anthropic_client.messages.create(
+                        **self._params_for(model_config, max_tokens),
+                        **self._anthropic_params(messages)
+                    )
+                    record_provider_call(model_config, started, "ok",
+                                         response.usage.input_tokens, response.usage.output_tokens)
+                    return response.content[0].text
                 
+                else:  # openai
+                    response = await async_openai_client.chat.completions.create(
+                        **self._params_for(model_config, max_tokens),
+                        messages=[self.openai_system_message] + messages
+                    )
+                    usage = response.usage
+                    record_provider_call(model_config, started, "ok",
+                                         usage.prompt_tokens if usage else None,
+                                         usage.completion_tokens if usage else None)
+                    return response.choices[0].message.content
+            except Exception:
+                record_provider_call(model_config, started, "error")
+                raise
+
+    async def astream(self, message: str, history: Optional[List[Dict[str, str]]] = None,
+                      max_tokens: Optional[int] = None) -> AsyncIterator[Tuple[str, str]]:
+        """Stream the agent's response as (text delta, serving "provider:model_id") pairs"""
+        messages = (history or []) + [{"role": "user", "content": message}]
+        max_tokens = max_tokens or DEFAULT_MAX_TOKENS
+        key = f"stream:{self._request_key(messages, max_tokens)}"
+        
+        # Identical concurrent streams subscribe to a single provider stream
+        async for chunk in request_coalescer.stream(key, lambda: self._provider_stream(messages, max_tokens)):
+            yield chunk
+
+    async def _provider_stream(self, messages: List[Dict[str, Any]], max_tokens: int) -> AsyncIterator[Tuple[str, str]]:
+        try:
+            async for text, served_by in provider_router.stream(
+                self.model_config,
+                lambda model_config: self._provider_stream_call(model_config, messages, max_tokens)
+            ):
+                yield text, provider_router.model_key(served_by)
         except Exception as e:
-            logger.error(f"Error in agent chat: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Chat failed: {str(e)}")
+            logger.error(f"Error in agent stream: {str(e)}")
+            raise
+
+    async def _provider_stream_call(self, model_config: Dict[str, str], messages: List[Dict[str, Any]],
+                                    max_tokens: int) -> AsyncIterator[str]:
+        """One streamed completion against a specific provider model"""
+        async with provider_slot(model_config["provider"]):
+            started = time.perf_counter()
+            try:
+                if model_config["provider"] == "anthropic":
+                    async with async_anthropic_client.messages.stream(
+                        **self._params_for(model_config, max_tokens),
+                        **self._anthropic_params(messages)
+                    ) as stream:
+                        async for text in stream.text_stream:
+                            yield text
+                        usage = (await stream.get_final_message()).usage
+                    record_provider_call(model_config, started, "ok", usage.input_tokens, usage.output_tokens)
+                
+                else:  # openai
+                    stream = await async_openai_client.chat.completions.create(
+                        **self._params_for(model_config, max_tokens),
+                        messages=[self.openai_system_message] + messages,
+                        stream=True
+                    )
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            yield chunk.choices[0].delta.content
+                    record_provider_call(model_config, started, "ok")
+            except Exception:
+                record_provider_call(model_config, started, "error")
+                raise
 
 def create_agent(config: AgentConfig):
     """Create a simple agent with the specified configuration"""
@@ -243,7 +2413,8 @@ def create_agent(config: AgentConfig):
         agent = Agent(
             instructions=config.instructions,
             model_config=model_config,
-            temperature=config.temperature
+            temperature=config.temperature,
+            name=config.name
         )
         
         return agent
@@ -252,6 +2423,167 @@ def create_agent(config: AgentConfig):
         logger.error(f"Error creating agent: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to create agent: {str(e)}")
 
+# Agent registry configuration
+AGENT_REGISTRY_MAX_SIZE = int(os.getenv("AGENT_REGISTRY_MAX_SIZE", "256"))
+AGENT_REGISTRY_IDLE_SECONDS = float(os.getenv("AGENT_REGISTRY_IDLE_SECONDS", "86400"))
+AGENT_REGISTRY_DB = os.getenv("AGENT_REGISTRY_DB")
+
+class AgentRegistry:
+    """Registered agents, built once and reused by every chat that targets them.
+
+    Agents live in an LRU bounded by max_size and are dropped after idle_seconds
+    without use. With a SQLite db_path the registry is persisted and shared by
+    all workers: a worker that has not seen an agent yet rebuilds it from its
+    stored config, and cached agents are re-checked periodically so deletes on
+    another worker take effect.
+    """
+
+    SWEEP_INTERVAL_SECONDS = 60
+    VERIFY_INTERVAL_SECONDS = 30
+
+    def __init__(self, max_size: int, idle_seconds: float, db_path: Optional[str] = None):
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.evictions = 0
+        self._agents: "OrderedDict[str, list]" = OrderedDict()  # id -> [agent, config, last_used, verified_at]
+        self._last_sweep = time.time()
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS agents "
+                "(agent_id TEXT PRIMARY KEY, config TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+
+    @staticmethod
+    def new_agent_id(name: str) -> str:
+        slug = re.sub(r"[^A-Za-z0-9_-]+", "_", name).strip("_") or "agent"
+        return f"{slug}_{uuid.uuid4().hex[:12]}"
+
+    async def create(self, config: AgentConfig) -> str:
+        """Build and register an agent, returning its id"""
+        agent = create_agent(config)
+        agent_id = self.new_agent_id(config.name)
+        now = time.time()
+        if self._db is not None:
+            await asyncio.to_thread(
+                self._db_execute,
+                "INSERT INTO agents (agent_id, config, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (agent_id, config.json(), now, now)
+            )
+        self._agents[agent_id] = [agent, config, now, now]
+        await self._evict()
+        return agent_id
+
+    async def get(self, agent_id: str) -> Optional[Agent]:
+        """Look up a registered agent, loading it from the shared registry if needed"""
+        now = time.time()
+        entry = self._agents.get(agent_id)
+        if entry is not None and self._db is not None and now - entry[3] >= self.VERIFY_INTERVAL_SECONDS:
+            # Confirm the agent still exists and record use for the shared idle sweep
+            entry[3] = now
+            updated = await asyncio.to_thread(
+                self._db_execute, "UPDATE agents SET last_used = ? WHERE agent_id = ?", (now, agent_id)
+            )
+            if not updated:
+                self._agents.pop(agent_id, None)
+                entry = None
+        
+        if entry is None and self._db is not None:
+            rows = await asyncio.to_thread(
+                self._db_fetch, "SELECT config FROM agents WHERE agent_id = ?", (agent_id,)
+            )
+            if rows:
+                # Another request may have loaded it while this one waited
+                entry = self._agents.get(agent_id)
+                if entry is None:
+                    config = AgentConfig.parse_raw(rows[0][0])
+                    entry = [create_agent(config), config, now, now]
+                    self._agents[agent_id] = entry
+        
+        if entry is None:
+            return None
+        
+        entry[2] = now
+        self._agents.move_to_end(agent_id)
+        await self._evict()
+        return entry[0]
+
+    async def delete(self, agent_id: str) -> bool:
+        """Remove an agent from the registry"""
+        removed = self._agents.pop(agent_id, None) is not None
+        if self._db is not None:
+            deleted = await asyncio.to_thread(
+                self._db_execute, "DELETE FROM agents WHERE agent_id = ?", (agent_id,)
+            )
+            removed = deleted > 0 or removed
+        return removed
+
+    async def list(self) -> List[Dict[str, Any]]:
+        """Describe every registered agent"""
+        if self._db is not None:
+            rows = await asyncio.to_thread(
+                self._db_fetch, "SELECT agent_id, config FROM agents ORDER BY created_at"
+            )
+            configs = [(agent_id, AgentConfig.parse_raw(config)) for agent_id, config in rows]
+        else:
+            configs = [(agent_id, entry[1]) for agent_id, entry in self._agents.items()]
+        
+        return [
+            {
+                "id": agent_id,
+                "name": config.name,
+                "model_provider": config.model_provider,
+                "model_id": get_model_config(config.model_provider, config.model_name)["model_id"]
+            }
+            for agent_id, config in configs
+        ]
+
+    def __len__(self) -> int:
+        """Agents loaded in this worker (no database round trip)"""
+        return len(self._agents)
+
+    def _db_execute(self, sql: str, params: tuple = ()) -> int:
+        with self._db_lock:
+            return self._db.execute(sql, params).rowcount
+
+    def _db_fetch(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._db_lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _db_sweep(self, cutoff: float):
+        with self._db_lock:
+            self._db.execute("DELETE FROM agents WHERE last_used < ?", (cutoff,))
+            self._db.execute(
+                "DELETE FROM agents WHERE agent_id NOT IN "
+                "(SELECT agent_id FROM agents ORDER BY last_used DESC LIMIT ?)",
+                (self.max_size,)
+            )
+
+    async def _evict(self):
+        now = time.time()
+        if now - self._last_sweep >= self.SWEEP_INTERVAL_SECONDS:
+            self._last_sweep = now
+            cutoff = now - self.idle_seconds
+            for agent_id in [aid for aid, entry in self._agents.items() if entry[2] < cutoff]:
+                del self._agents[agent_id]
+                self.evictions += 1
+            if self._db is not None:
+                await asyncio.to_thread(self._db_sweep, cutoff)
+        
+        while len(self._agents) > self.max_size:
+            self._agents.popitem(last=False)
+            self.evictions += 1
+
+# Global agent registry
+agent_registry = AgentRegistry(
+    max_size=AGENT_REGISTRY_MAX_SIZE,
+    idle_seconds=AGENT_REGISTRY_IDLE_SECONDS,
+    db_path=AGENT_REGISTRY_DB
+)
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
@@ -266,18 +2598,58 @@ async def health_check():
     """Detailed health check"""
     return {
         "status": "healthy",
-        "anthropic_configured": bool(anthropic_client),
-        "openai_configured": bool(openai_client),
-        "active_agents": len(agents)
+        "anthropic_configured": provider_configured("anthropic"),
+        "openai_configured": provider_configured("openai"),
+        "active_agents": len(agent_registry),
+        "response_cache": response_cache.stats(),
+        "request_coalescing": request_coalescer.stats(),
+        "sessions": session_store.stats(),
+        "context_store": context_store.stats(),
+        "vector_index": vector_index.stats(),
+        "router": provider_router.stats(),
+        "admission": admission_controller.stats()
+    }
+
+def render_stats_metrics() -> List[str]:
+    """Expose cache, coalescing, session and context counters in Prometheus format"""
+    sources = {
+        "response_cache": response_cache.stats(),
+        "request_coalescing": request_coalescer.stats(),
+        "sessions": session_store.stats(),
+        "context_store": context_store.stats(),
+        "vector_index": vector_index.stats(),
+        "admission": admission_controller.stats()
     }
+    lines = []
+    for source, stats in sources.items():
+        for name, value in stats.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            metric = f"agno_{source}_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+    
+    for model, stats in provider_router.stats()["models"].items():
+        provider, model_id = model.split(":", 1)
+        labels = f'provider="{provider}",model="{model_id}"'
+        lines.append(f'agno_router_circuit_open{{{labels}}} {int(stats["state"] != "closed")}')
+        lines.append(f'agno_router_error_rate{{{labels}}} {stats["error_rate"]}')
+    return lines
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(render_stats_metrics())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 @app.post("/api/agent/create", response_model=Dict[str, str])
 async def create_agent_endpoint(config: AgentConfig):
     """Create a new agent"""
     try:
-        agent = create_agent(config)
-        agent_id = f"{config.name}_{len(agents)}"
-        agents[agent_id] = agent
+        agent_id = await agent_registry.create(config)
         
         return {
             "agent_id": agent_id,
@@ -288,65 +2660,588 @@ async def create_agent_endpoint(config: AgentConfig):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@lru_cache(maxsize=64)
+def get_chat_agent(provider: str, model_name: Optional[str] = None) -> Agent:
+    """Get the generic agent for a provider/model, built once and reused"""
+    model_config = get_model_config(provider, model_name)
+    return Agent(
+        instructions=DEFAULT_CHAT_INSTRUCTIONS,
+        model_config=model_config,
+        temperature=0.7
+    )
+
+async def build_chat_agent(request: ChatRequest) -> Agent:
+    """Get the agent that serves a chat request"""
+    if request.agent_id:
+        agent = await agent_registry.get(request.agent_id)
+        if agent is None:
+            raise HTTPException(status_code=404, detail=f"Agent not found: {request.agent_id}")
+        return agent
+    return get_chat_agent(request.model_provider, request.model_name)
+
+async def resolve_context(request: ChatRequest) -> str:
+    """Rendered context section for a request, inline or from the context store"""
+    if isinstance(request.context, str):
+        rendered = await context_store.get(request.context)
+        if rendered is None:
+            raise HTTPException(status_code=404, detail=f"Context not found: {request.context}")
+        return rendered
+    return render_context(request.context)
+
+def admission_params(request: ChatRequest, default_priority: str = "interactive") -> Dict[str, Any]:
+    """Validated max_tokens, tenant and priority class for a request"""
+    priority = request.priority or default_priority
+    if priority not in PRIORITY_CLASSES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported priority: {priority} (expected one of {', '.join(PRIORITY_CLASSES)})"
+        )
+    max_tokens = request.max_tokens or DEFAULT_MAX_TOKENS
+    if max_tokens > MAX_TOKENS_LIMIT:
+        raise HTTPException(status_code=400, detail=f"max_tokens too large: {max_tokens} (max {MAX_TOKENS_LIMIT})")
+    return {
+        "max_tokens": max_tokens,
+        "tenant": request.tenant_id or DEFAULT_TENANT,
+        "priority": priority
+    }
+
+def session_history(request: ChatRequest) -> List[Dict[str, str]]:
+    """Prior turns for the request's session, trimmed to the history token budget"""
+    if not request.session_id:
+        return []
+    return session_store.history(request.session_id, SESSION_HISTORY_TOKEN_BUDGET)
+
+async def run_chat(request: ChatRequest, agent: Optional[Agent] = None,
+                   default_priority: str = "interactive", preamble: str = "") -> ChatResponse:
+    """Run a chat request through its agent and build the response.
+
+    Context and preamble (e.g. retrieved passages) are sent with this request
+    only; the session records just the user's message.
+    """
+    admission = admission_params(request, default_priority)
+    validator = get_schema_validator(request.response_schema) if request.response_schema is not None else None
+    
+    # Create agent with instructions
+    agent = agent or await build_chat_agent(request)
+    with timed_stage("context"):
+        message = f"{await resolve_context(request)}{preamble}{request.message}"
+        if validator is not None:
+            message += structured_output_instruction(request.response_schema)
+        history = session_history(request)
+    
+    # Get response from agent
+    response, model_used = await agent.achat(message, use_cache=request.use_cache, history=history, **admission)
+    if validator is not None:
+        response, model_used = await agent.conform(
+            message, response, model_used, validator, history=history, use_cache=request.use_cache, **admission
+        )
+    if request.session_id:
+        session_store.append(request.session_id, request.message, response)
+    
+    # Format the response if it's a RAG result
+    if validator is None:
+        with timed_stage("format"):
+            response = format_agent_response(response)
+    
+    # Create response object
+    return ChatResponse(
+        response=response,
+        session_id=request.session_id,
+        model_used=model_used
+    )
+
 @app.post("/api/agent/chat")
 async def chat(request: ChatRequest):
     """Chat with an agent"""
     try:
-        # Get model configuration
-        model_config = get_model_config(request.model_provider, request.model_name)
+        chat_response = await run_chat(request)
         
-        # Create agent with instructions
-        agent = Agent(
-            instructions="You are a helpful AI assistant. Please provide clear and concise responses.",
-            model_config=model_config,
-            temperature=0.7
+        with timed_stage("serialize"):
+            return ORJSONResponse(chat_response.dict())
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in chat endpoint: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/agent/chat/batch")
+async def chat_batch(batch: BatchChatRequest):
+    """Run independent chat requests concurrently and return per-item results in order"""
+    if len(batch.requests) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Batch too large: {len(batch.requests)} requests (max {BATCH_MAX_ITEMS})"
+        )
+    
+    limit = min(batch.max_concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+    semaphore = asyncio.Semaphore(max(limit, 1))
+
+    async def run_item(index: int, request: ChatRequest) -> BatchChatItem:
+        async with semaphore:
+            try:
+                return BatchChatItem(index=index, ok=True, result=await run_chat(request, default_priority="batch"))
+            except HTTPException as e:
+                return BatchChatItem(index=index, ok=False, error=str(e.detail), status_code=e.status_code)
+            except Exception as e:
+                logger.error(f"Error in batch item {index}: {str(e)}")
+                return BatchChatItem(index=index, ok=False, error=str(e), status_code=500)
+
+    results = await asyncio.gather(*(run_item(i, r) for i, r in enumerate(batch.requests)))
+    succeeded = sum(1 for item in results if item.ok)
+    return {
+        "results": [item.dict() for item in results],
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded
+    }
+
+@app.post("/api/agent/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Chat with an agent, streaming token deltas as Server-Sent Events"""
+    admission = admission_params(request)
+    validator = get_schema_validator(request.response_schema) if request.response_schema is not None else None
+    agent = await build_chat_agent(request)
+    model_config = agent.model_config
+    message = f"{await resolve_context(request)}{request.message}"
+    if validator is not None:
+        message += structured_output_instruction(request.response_schema)
+    history = session_history(request)
+    
+    # Admit before the response starts so rejection is a plain 429
+    messages = history + [{"role": "user", "content": message}]
+    admitted_at = await admission_controller.acquire(
+        admission["tenant"], model_config["provider"], admission["priority"],
+        agent.estimate_request_tokens(messages, admission["max_tokens"])
+    )
+    released = False
+
+    def release_slot():
+        # Runs from the generator and again as a background task in case the
+        # client disconnected before the generator started
+        nonlocal released
+        if not released:
+            released = True
+            admission_controller.release(admitted_at)
+
+    async def event_stream():
+        stripper = JsonFenceStripper()
+        chunks = []
+        model_used = None
+        try:
+            async for delta, model_used in agent.astream(message, history=history, max_tokens=admission["max_tokens"]):
+                chunks.append(delta)
+                text = stripper.feed(delta)
+                if text:
+                    yield sse_event("delta", {"text": text})
+            
+            text = stripper.finish()
+            if text:
+                yield sse_event("delta", {"text": text})
+            
+            # Final event carries the parsed object, same shape as /api/agent/chat
+            response = clean_json_response("".join(chunks))
+            if validator is not None:
+                # A repair is a new call with its own admission
+                release_slot()
+                response, model_used = await agent.conform(
+                    message, response, model_used, validator, history=history, use_cache=request.use_cache, **admission
+                )
+            if request.session_id:
+                session_store.append(request.session_id, request.message, response)
+            chat_response = ChatResponse(
+                response=response if validator is not None else format_agent_response(response),
+                session_id=request.session_id,
+                model_used=model_used
+            )
+            yield sse_event("done", chat_response.dict())
+        except HTTPException as e:
+            # e.g. a 422 after structured output repair, or a 429 from admission
+            logger.error(f"Error in chat stream endpoint: {e.detail}")
+            yield sse_event("error", {"detail": e.detail, "status_code": e.status_code})
+        except Exception as e:
+            logger.error(f"Error in chat stream endpoint: {str(e)}")
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            release_slot()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(release_slot)
+    )
+
+TEMPLATE_PATTERN = re.compile(r"\{\{\s*([^{}]+?)\s*\}\}")
+
+@lru_cache(maxsize=128)
+def get_instruction_agent(instructions: str, provider: str, model_name: Optional[str], temperature: float) -> Agent:
+    """Get an agent for inline pipeline instructions, built once and reused"""
+    return Agent(
+        instructions=instructions,
+        model_config=get_model_config(provider, model_name),
+        temperature=temperature
+    )
+
+def step_dependencies(step: PipelineStep) -> List[str]:
+    """Explicit dependencies plus steps referenced from the message template"""
+    deps = list(step.depends_on)
+    for path in TEMPLATE_PATTERN.findall(step.message):
+        parts = path.split(".")
+        if parts[0] == "steps" and len(parts) > 1 and parts[1] not in deps:
+            deps.append(parts[1])
+    return deps
+
+def plan_pipeline(pipeline: PipelineRequest) -> Dict[str, List[str]]:
+    """Validate the pipeline DAG and return each step's dependencies"""
+    if not pipeline.steps:
+        raise HTTPException(status_code=400, detail="Pipeline has no steps")
+    if len(pipeline.steps) > PIPELINE_MAX_STEPS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Pipeline too large: {len(pipeline.steps)} steps (max {PIPELINE_MAX_STEPS})"
         )
+    
+    graph = {}
+    for step in pipeline.steps:
+        if step.id in graph:
+            raise HTTPException(status_code=400, detail=f"Duplicate step id: {step.id}")
+        graph[step.id] = step_dependencies(step)
+    
+    for step_id, deps in graph.items():
+        for dep in deps:
+            if dep not in graph:
+                raise HTTPException(status_code=400, detail=f"Step '{step_id}' depends on unknown step '{dep}'")
+    
+    # Kahn's algorithm: anything left over sits on a cycle
+    remaining = {step_id: len(deps) for step_id, deps in graph.items()}
+    ready = [step_id for step_id, count in remaining.items() if count == 0]
+    while ready:
+        done = ready.pop()
+        del remaining[done]
+        for step_id, deps in graph.items():
+            if done in deps and step_id in remaining:
+                remaining[step_id] -= 1
+                if remaining[step_id] == 0:
+                    ready.append(step_id)
+    if remaining:
+        raise HTTPException(status_code=400, detail=f"Pipeline has a cycle through: {', '.join(sorted(remaining))}")
+    
+    return graph
+
+def render_step_message(template: str, pipeline_input: Any, results: Dict[str, PipelineStepResult]) -> str:
+    """Fill {{input}} and {{steps.<id>}} placeholders in a step message"""
+    def lookup(match):
+        parts = match.group(1).split(".")
+        if parts[0] == "input":
+            value, fields = pipeline_input, parts[1:]
+        elif parts[0] == "steps" and len(parts) > 1:
+            value, fields = results[parts[1]].response, parts[2:]
+        else:
+            raise ValueError(f"Unknown template reference: {match.group(1)}")
         
-        # Get response from agent
-        response = agent.chat(request.message)
+        for field in fields:
+            if isinstance(value, dict) and field in value:
+                value = value[field]
+            elif isinstance(value, list) and field.isdigit() and int(field) < len(value):
+                value = value[int(field)]
+            else:
+                raise ValueError(f"Template reference not found: {match.group(1)}")
         
-        # Format the response if it's a RAG result
-        if isinstance(response, dict) and "ragResult" in response:
-            rag_result = response["ragResult"]
-            if "answer" in rag_result and "sources" in rag_result:
-                response = format_rag_response(rag_result["answer"], rag_result["sources"])
+        if isinstance(value, str):
+            return value
+        return json.dumps(value, separators=(",", ":"), default=str)
+    
+    return TEMPLATE_PATTERN.sub(lookup, template)
+
+async def run_pipeline(pipeline: PipelineRequest, graph: Dict[str, List[str]]) -> AsyncIterator[PipelineStepResult]:
+    """Run pipeline steps as their dependencies finish, yielding results in completion order"""
+    limit = min(pipeline.max_concurrency or PIPELINE_MAX_CONCURRENCY, PIPELINE_MAX_CONCURRENCY)
+    semaphore = asyncio.Semaphore(max(limit, 1))
+    results: Dict[str, PipelineStepResult] = {}
+    tasks: Dict[str, asyncio.Task] = {}
+
+    async def run_step(step: PipelineStep) -> PipelineStepResult:
+        deps = graph[step.id]
+        if deps:
+            await asyncio.wait([tasks[dep] for dep in deps])
+        failed = [dep for dep in deps if not results[dep].ok]
+        if failed:
+            result = PipelineStepResult(
+                id=step.id, ok=False, status_code=424,
+                error=f"Skipped: dependency failed ({', '.join(failed)})"
+            )
+            results[step.id] = result
+            return result
         
-        # Create response object
-        chat_response = ChatResponse(
-            response=response,
-            model_used=f"{model_config['provider']}:{model_config['model_id']}"
-        )
+        try:
+            message = render_step_message(step.message, pipeline.input, results)
+        except ValueError as e:
+            result = PipelineStepResult(id=step.id, ok=False, error=str(e), status_code=422)
+            results[step.id] = result
+            return result
         
-        # Convert to dict for JSON serialization
-        return chat_response.dict()
-    except Exception as e:
-        logger.error(f"Error in chat endpoint: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                request = ChatRequest(
+                    message=message,
+                    model_provider=step.model_provider,
+                    model_name=step.model_name,
+                    context=step.context,
+                    use_cache=step.use_cache,
+                    agent_id=step.agent_id,
+                    max_tokens=step.max_tokens,
+                    priority=step.priority,
+                    tenant_id=pipeline.tenant_id,
+                    response_schema=step.response_schema
+                )
+                agent = None
+                if step.instructions and not step.agent_id:
+                    agent = get_instruction_agent(step.instructions, step.model_provider, step.model_name, step.temperature)
+                chat_response = await run_chat(request, agent=agent)
+                result = PipelineStepResult(
+                    id=step.id, ok=True,
+                    response=chat_response.response,
+                    model_used=chat_response.model_used
+                )
+            except HTTPException as e:
+                result = PipelineStepResult(id=step.id, ok=False, error=str(e.detail), status_code=e.status_code)
+            except Exception as e:
+                logger.error(f"Error in pipeline step {step.id}: {str(e)}")
+                result = PipelineStepResult(id=step.id, ok=False, error=str(e), status_code=500)
+            result.elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+        
+        results[step.id] = result
+        return result
+
+    for step in pipeline.steps:
+        tasks[step.id] = asyncio.ensure_future(run_step(step))
+    try:
+        for finished in asyncio.as_completed(list(tasks.values())):
+            yield await finished
+    finally:
+        # Stop outstanding steps if the client went away
+        for task in tasks.values():
+            task.cancel()
+
+@app.post("/api/agent/pipeline")
+async def agent_pipeline(pipeline: PipelineRequest):
+    """Run a DAG of agent steps and return every step's result in one response"""
+    graph = plan_pipeline(pipeline)
+    started = time.perf_counter()
+    
+    results = {}
+    async for result in run_pipeline(pipeline, graph):
+        results[result.id] = result
+    
+    ordered = [results[step.id].dict() for step in pipeline.steps]
+    succeeded = sum(1 for result in ordered if result["ok"])
+    return {
+        "steps": ordered,
+        "succeeded": succeeded,
+        "failed": len(ordered) - succeeded,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)
+    }
+
+@app.post("/api/agent/pipeline/stream")
+async def agent_pipeline_stream(pipeline: PipelineRequest):
+    """Run a DAG of agent steps, streaming each step's result as Server-Sent Events"""
+    graph = plan_pipeline(pipeline)
+
+    async def event_stream():
+        started = time.perf_counter()
+        succeeded = failed = 0
+        try:
+            async for result in run_pipeline(pipeline, graph):
+                if result.ok:
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield sse_event("step", result.dict())
+            
+            yield sse_event("done", {
+                "succeeded": succeeded,
+                "failed": failed,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)
+            })
+        except Exception as e:
+            logger.error(f"Error in pipeline stream endpoint: {str(e)}")
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.get("/api/agent/list")
 async def list_agents():
     """List all active agents"""
+    agents = await agent_registry.list()
     return {
-        "agents": [
-            {
-                "id": agent_id,
-                "name": agent.instructions,
-                "model_provider": agent.model_config["provider"],
-                "model_id": agent.model_config["model_id"]
-            }
-            for agent_id, agent in agents.items()
-        ]
+        "agents": agents,
+        "total": len(agents)
     }
 
 @app.delete("/api/agent/{agent_id}")
 async def delete_agent(agent_id: str):
     """Delete an agent"""
-    if agent_id not in agents:
+    if not await agent_registry.delete(agent_id):
         raise HTTPException(status_code=404, detail="Agent not found")
     
-    del agents[agent_id]
     return {"message": f"Agent {agent_id} deleted successfully"}
 
+@app.delete("/api/session/{session_id}")
+async def delete_session(session_id: str):
+    """Forget a session's conversation history"""
+    if not session_store.clear(session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    return {"message": f"Session {session_id} deleted successfully"}
+
+def store_context(body: bytes) -> Dict[str, Any]:
+    """Parse an uploaded context and add it to the context store"""
+    try:
+        context = json.loads(body)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON: {str(e)}")
+    if not isinstance(context, dict):
+        raise HTTPException(status_code=400, detail="Context must be a JSON object")
+    
+    return context_store.put(context)
+
+@app.put("/api/context")
+async def put_context(request: Request):
+    """Upload request context once and get a content hash to reference it by"""
+    body = await request.body()
+    if len(body) > CONTEXT_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Context too large (max {CONTEXT_MAX_UPLOAD_BYTES} bytes)")
+    
+    # Parsing, hashing and any spill writes stay off the event loop
+    return await asyncio.to_thread(store_context, body)
+
+@app.get("/api/context/{context_id}")
+async def get_context(context_id: str):
+    """Check whether a context is stored"""
+    rendered = await context_store.get(context_id)
+    if rendered is None:
+        raise HTTPException(status_code=404, detail="Context not found")
+    
+    return {"context_id": context_id, "bytes": len(rendered.encode("utf-8"))}
+
+def check_top_k(top_k: int):
+    if not 1 <= top_k <= RAG_MAX_TOP_K:
+        raise HTTPException(status_code=400, detail=f"top_k must be between 1 and {RAG_MAX_TOP_K}")
+
+async def retrieve(queries: Optional[List[str]], vectors: Optional[List[List[float]]],
+                   top_k: int) -> List[List[Dict[str, Any]]]:
+    """Embed queries if needed and search the vector index for all of them at once"""
+    if vectors is None:
+        with timed_stage("embed"):
+            vectors = await embed_texts(queries)
+    with timed_stage("retrieve"):
+        try:
+            return await asyncio.to_thread(vector_index.search, np.asarray(vectors, dtype=np.float32), top_k)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+def render_passages(matches: List[Dict[str, Any]]) -> str:
+    """Numbered passages for the answer prompt, in the order of the sources list"""
+    if not matches:
+        return "Passages: none found\n\n"
+    lines = ["Passages:"]
+    for idx, match in enumerate(matches, 1):
+        metadata = match["metadata"]
+        source = f" (source: {metadata['source']})" if "source" in metadata else ""
+        lines.append(f"[{idx}]{source} {metadata.get('text', '')}")
+    return "\n".join(lines) + "\n\n"
+
+@app.post("/api/rag/upsert")
+async def rag_upsert(request: RagUpsertRequest):
+    """Add or replace documents in the local vector index"""
+    documents = request.documents
+    if not documents:
+        raise HTTPException(status_code=400, detail="No documents to upsert")
+    if len(documents) > RAG_MAX_UPSERT_DOCUMENTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many documents: {len(documents)} (max {RAG_MAX_UPSERT_DOCUMENTS})"
+        )
+    missing = [doc.id for doc in documents if doc.vector is None and not doc.text]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Documents need text or a vector: {', '.join(missing[:10])}")
+    
+    # Embed all text-only documents in one batched call
+    to_embed = [i for i, doc in enumerate(documents) if doc.vector is None]
+    embedded = await embed_texts([documents[i].text for i in to_embed]) if to_embed else None
+    vectors = [doc.vector for doc in documents]
+    for position, i in enumerate(to_embed):
+        vectors[i] = embedded[position]
+    try:
+        matrix = np.asarray(vectors, dtype=np.float32)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="All vectors must have the same dimension")
+    
+    metadata = [
+        {**doc.metadata, "text": doc.text} if doc.text and "text" not in doc.metadata else doc.metadata
+        for doc in documents
+    ]
+    try:
+        result = await asyncio.to_thread(vector_index.upsert, [doc.id for doc in documents], matrix, metadata)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"upserted": len(documents), **result}
+
+@app.post("/api/rag/search")
+async def rag_search(request: RagSearchRequest):
+    """Top-k matches for a batch of queries, without answer generation"""
+    check_top_k(request.top_k)
+    if (request.queries is None) == (request.vectors is None):
+        raise HTTPException(status_code=400, detail="Send either queries or vectors")
+    count = len(request.queries or request.vectors)
+    if not 1 <= count <= RAG_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {RAG_MAX_QUERIES} queries")
+    
+    matches = await retrieve(request.queries, request.vectors, request.top_k)
+    return {"results": [{"matches": query_matches} for query_matches in matches]}
+
+@app.post("/api/rag/query")
+async def rag_query(request: RagQueryRequest):
+    """Answer a question from the local vector index in one call"""
+    check_top_k(request.top_k)
+    vectors = [request.vector] if request.vector is not None else None
+    matches = (await retrieve([request.query], vectors, request.top_k))[0]
+    if request.min_score is not None:
+        matches = [match for match in matches if match["score"] >= request.min_score]
+    
+    agent = get_instruction_agent(
+        request.instructions or RAG_INSTRUCTIONS, request.model_provider, request.model_name, request.temperature
+    )
+    chat_response = await run_chat(ChatRequest(
+        message=request.query,
+        session_id=request.session_id,
+        model_provider=request.model_provider,
+        model_name=request.model_name,
+        use_cache=request.use_cache,
+        max_tokens=request.max_tokens,
+        priority=request.priority,
+        tenant_id=request.tenant_id
+    ), agent=agent, preamble=f"{render_passages(matches)}Question: ")
+    
+    answer = chat_response.response
+    with timed_stage("format"):
+        formatted = format_rag_response(
+            answer if isinstance(answer, str) else orjson.dumps(answer).decode(), matches
+        )
+    rag_response = RagQueryResponse(
+        response=formatted,
+        answer=answer,
+        sources=matches,
+        session_id=request.session_id,
+        model_used=chat_response.model_used
+    )
+    with timed_stage("serialize"):
+        return ORJSONResponse(rag_response.dict())
+
 @app.get("/api/models/{provider}")
 async def get_available_models(provider: str):
     """Get available models for a provider"""
@@ -371,6 +3266,16 @@ async def get_available_models(provider: str):
     else:
         raise HTTPException(status_code=400, detail=f"Unsupported provider: {provider}")
 
+@app.on_event("shutdown")
+async def close_provider_clients():
+    """Release pooled provider connections"""
+    await async_http_client.aclose()
+
+@app.on_event("shutdown")
+async def flush_context_store():
+    """Spill in-memory contexts so they survive the restart"""
+    await asyncio.to_thread(context_store.flush)
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     """Global exception handler"""
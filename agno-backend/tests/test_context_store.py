@@ -0,0 +1,32 @@
+"""
+ContextStore shared through a spill directory, as with several workers on a host.
+"""
+import asyncio
+import os
+
+from main import ContextStore
+
+def test_upload_is_visible_to_another_worker(tmp_path):
+    worker_a = ContextStore(max_bytes=1024 * 1024, spill_dir=str(tmp_path))
+    worker_b = ContextStore(max_bytes=1024 * 1024, spill_dir=str(tmp_path))
+    
+    stored = worker_a.put({"site": "North", "crews": [1, 2, 3]})
+    text = asyncio.run(worker_b.get(stored["context_id"]))
+    assert text is not None and "North" in text
+    assert worker_b.stats()["spill_reads"] == 1
+
+def test_memory_cap_still_applies_with_write_through(tmp_path):
+    store = ContextStore(max_bytes=200, spill_dir=str(tmp_path))
+    ids = [store.put({"doc": i, "text": "x" * 100})["context_id"] for i in range(5)]
+    
+    assert store.stats()["bytes"] <= 200
+    assert len(os.listdir(tmp_path)) == 5
+    assert "x" * 100 in asyncio.run(store.get(ids[0]))
+
+def test_without_spill_dir_contexts_are_per_worker():
+    worker_a = ContextStore(max_bytes=1024 * 1024)
+    worker_b = ContextStore(max_bytes=1024 * 1024)
+    
+    stored = worker_a.put({"site": "North"})
+    assert asyncio.run(worker_a.get(stored["context_id"])) is not None
+    assert asyncio.run(worker_b.get(stored["context_id"])) is None
@@ -0,0 +1,236 @@
+"""
+ProviderRouter against stub providers: breaker states, failover and hedging.
+
+The provider call and the configured-provider check are injected, so no
+provider keys or network access are needed.
+"""
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from main import ProviderRouter
+
+PRIMARY = {"provider": "anthropic", "model_id": "claude-3-haiku-20240307"}
+EQUIVALENT = {"provider": "openai", "model_id": "gpt-3.5-turbo"}
+EQUIVALENTS = [["anthropic:claude-3-haiku-20240307", "openai:gpt-3.5-turbo"]]
+
+class ProviderError(Exception):
+    def __init__(self, status_code: int = 500):
+        super().__init__(f"stub provider error {status_code}")
+        self.status_code = status_code
+
+class StubProvider:
+    """Answers or fails per model, recording every call"""
+
+    def __init__(self, failing=(), delays=None, status_code=500):
+        self.failing = set(failing)
+        self.delays = delays or {}
+        self.status_code = status_code
+        self.calls = []
+        self.cancelled = []
+
+    async def __call__(self, model_config):
+        key = ProviderRouter.model_key(model_config)
+        self.calls.append(key)
+        try:
+            await asyncio.sleep(self.delays.get(key, 0))
+        except asyncio.CancelledError:
+            self.cancelled.append(key)
+            raise
+        if key in self.failing:
+            raise ProviderError(self.status_code)
+        return f"answer from {key}"
+
+@pytest.fixture(autouse=True)
+def router_settings(monkeypatch):
+    monkeypatch.setattr(main, "ROUTER_MIN_REQUESTS", 2)
+    monkeypatch.setattr(main, "ROUTER_ERROR_THRESHOLD", 0.5)
+    monkeypatch.setattr(main, "ROUTER_OPEN_SECONDS", 0.05)
+    monkeypatch.setattr(main, "ROUTER_HEDGE_DEFAULT_DELAY_MS", 20)
+    monkeypatch.setattr(main, "ROUTER_HEDGE_MIN_DELAY_MS", 10)
+
+def make_router(configured=("anthropic", "openai"), **kwargs):
+    return ProviderRouter(EQUIVALENTS, is_configured=lambda provider: provider in configured, **kwargs)
+
+def call(router, provider):
+    return asyncio.run(router.call(PRIMARY, provider))
+
+def test_breaker_opens_after_errors_and_closes_after_successful_probe():
+    router = make_router(failover=False)
+    provider = StubProvider(failing=["anthropic:claude-3-haiku-20240307"])
+    
+    for _ in range(2):
+        with pytest.raises(ProviderError):
+            call(router, provider)
+    assert router.stats_for(PRIMARY).state == "open"
+    
+    # Open: rejected without reaching the provider
+    with pytest.raises(HTTPException) as rejected:
+        call(router, provider)
+    assert rejected.value.status_code == 503
+    assert "Retry-After" in rejected.value.headers
+    assert len(provider.calls) == 2
+    
+    # After the open period a single probe is let through
+    time.sleep(0.06)
+    provider.failing.clear()
+    assert call(router, provider) == ("answer from anthropic:claude-3-haiku-20240307", PRIMARY)
+    assert router.stats_for(PRIMARY).state == "closed"
+
+def test_failed_probe_reopens_breaker():
+    router = make_router(failover=False)
+    provider = StubProvider(failing=["anthropic:claude-3-haiku-20240307"])
+    for _ in range(2):
+        with pytest.raises(ProviderError):
+            call(router, provider)
+    
+    time.sleep(0.06)
+    assert router.candidates(PRIMARY) == [PRIMARY]
+    assert router.stats_for(PRIMARY).state == "half_open"
+    with pytest.raises(ProviderError):
+        call(router, provider)
+    assert router.stats_for(PRIMARY).state == "open"
+
+def test_half_open_admits_one_probe_at_a_time():
+    router = make_router(failover=False)
+    stats = router.stats_for(PRIMARY)
+    stats.state = "open"
+    stats.opened_at = time.time() - 1
+    provider = StubProvider(delays={"anthropic:claude-3-haiku-20240307": 0.05})
+
+    async def concurrent():
+        probe = asyncio.ensure_future(router.call(PRIMARY, provider))
+        await asyncio.sleep(0.01)
+        with pytest.raises(HTTPException):
+            await router.call(PRIMARY, provider)
+        return await probe
+
+    result, served_by = asyncio.run(concurrent())
+    assert served_by == PRIMARY
+    assert provider.calls == ["anthropic:claude-3-haiku-20240307"]
+    assert stats.state == "closed"
+
+def test_failover_reports_serving_model():
+    router = make_router()
+    provider = StubProvider(failing=["anthropic:claude-3-haiku-20240307"])
+    
+    result, served_by = call(router, provider)
+    assert result == "answer from openai:gpt-3.5-turbo"
+    assert served_by == EQUIVALENT
+    assert router.failovers == 1
+
+def test_open_primary_routes_straight_to_equivalent():
+    router = make_router()
+    provider = StubProvider(failing=["anthropic:claude-3-haiku-20240307"])
+    for _ in range(2):
+        call(router, provider)
+    assert router.stats_for(PRIMARY).state == "open"
+    
+    provider.calls.clear()
+    assert call(router, provider)[1] == EQUIVALENT
+    assert provider.calls == ["openai:gpt-3.5-turbo"]
+
+def test_no_failover_to_unconfigured_provider():
+    router = make_router(configured=("anthropic",))
+    provider = StubProvider(failing=["anthropic:claude-3-haiku-20240307"])
+    with pytest.raises(ProviderError):
+        call(router, provider)
+    assert provider.calls == ["anthropic:claude-3-haiku-20240307"]
+    assert router.failovers == 0
+
+def test_non_retriable_error_does_not_fail_over_or_count():
+    router = make_router()
+    provider = StubProvider(failing=["anthropic:claude-3-haiku-20240307"], status_code=400)
+    for _ in range(3):
+        with pytest.raises(ProviderError):
+            call(router, provider)
+    assert provider.calls == ["anthropic:claude-3-haiku-20240307"] * 3
+    assert router.stats_for(PRIMARY).state == "closed"
+
+def test_hedge_wins_when_primary_is_slow():
+    router = make_router(hedge=True)
+    provider = StubProvider(delays={"anthropic:claude-3-haiku-20240307": 1.0})
+    
+    started = time.perf_counter()
+    result, served_by = call(router, provider)
+    assert time.perf_counter() - started < 0.5
+    assert served_by == EQUIVALENT
+    assert router.hedges == 1
+    assert provider.cancelled == ["anthropic:claude-3-haiku-20240307"]
+
+def test_hedge_not_sent_when_primary_is_fast():
+    router = make_router(hedge=True)
+    provider = StubProvider()
+    assert call(router, provider)[1] == PRIMARY
+    assert provider.calls == ["anthropic:claude-3-haiku-20240307"]
+    assert router.hedges == 0
+
+def test_hedged_call_fails_over_on_error():
+    router = make_router(hedge=True)
+    provider = StubProvider(failing=["anthropic:claude-3-haiku-20240307"])
+    assert call(router, provider)[1] == EQUIVALENT
+    assert router.failovers == 1
+    assert router.hedges == 0
+
+def test_stream_fails_over_before_first_delta():
+    router = make_router()
+
+    async def open_stream(model_config):
+        if model_config["provider"] == "anthropic":
+            raise ProviderError()
+        for text in ("a", "b"):
+            yield text
+
+    async def collect():
+        return [chunk async for chunk in router.stream(PRIMARY, open_stream)]
+
+    assert asyncio.run(collect()) == [("a", EQUIVALENT), ("b", EQUIVALENT)]
+    assert router.failovers == 1
+
+def half_open_router():
+    router = make_router(failover=False)
+    stats = router.stats_for(PRIMARY)
+    stats.state = "open"
+    stats.opened_at = time.time() - 1
+    return router, stats
+
+async def slow_stream(model_config):
+    for text in ("a", "b", "c"):
+        yield text
+        await asyncio.sleep(0.05)
+
+def test_closing_half_open_probe_stream_frees_the_probe():
+    router, stats = half_open_router()
+
+    async def close_after_first_delta():
+        stream = router.stream(PRIMARY, slow_stream)
+        assert await stream.__anext__() == ("a", PRIMARY)
+        await stream.aclose()
+
+    asyncio.run(close_after_first_delta())
+    assert stats.state == "half_open"
+    assert not stats.probe_in_flight
+    assert router.candidates(PRIMARY) == [PRIMARY]
+
+def test_cancelled_half_open_probe_stream_frees_the_probe():
+    router, stats = half_open_router()
+
+    async def cancel_after_first_delta():
+        received = []
+
+        async def consume():
+            async for chunk in router.stream(PRIMARY, slow_stream):
+                received.append(chunk)
+
+        consumer = asyncio.ensure_future(consume())
+        while not received:
+            await asyncio.sleep(0.01)
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+
+    asyncio.run(cancel_after_first_delta())
+    assert not stats.probe_in_flight
+    assert router.candidates(PRIMARY) == [PRIMARY]
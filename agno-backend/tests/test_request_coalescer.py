@@ -0,0 +1,92 @@
+"""
+RequestCoalescer against a stub upstream stream.
+"""
+import asyncio
+
+from main import RequestCoalescer
+
+class StubStream:
+    """Yields numbered chunks, recording how many were produced"""
+
+    def __init__(self, chunks: int = 10, delay: float = 0.01):
+        self.chunks = chunks
+        self.delay = delay
+        self.produced = 0
+        self.opened = 0
+        self.closed = False
+
+    async def __call__(self):
+        self.opened += 1
+        try:
+            for i in range(self.chunks):
+                await asyncio.sleep(self.delay)
+                self.produced += 1
+                yield str(i)
+        finally:
+            self.closed = True
+
+async def take(stream, count: int):
+    chunks = []
+    async for chunk in stream:
+        chunks.append(chunk)
+        if len(chunks) == count:
+            break
+    return chunks
+
+def test_identical_streams_share_one_upstream():
+    coalescer = RequestCoalescer()
+    upstream = StubStream(chunks=5)
+
+    async def both():
+        return await asyncio.gather(
+            take(coalescer.stream("k", upstream), 5),
+            take(coalescer.stream("k", upstream), 5)
+        )
+
+    assert asyncio.run(both()) == [["0", "1", "2", "3", "4"]] * 2
+    assert upstream.opened == 1
+    assert coalescer.coalesced == 1
+
+def test_upstream_cancelled_when_last_subscriber_leaves():
+    coalescer = RequestCoalescer()
+    upstream = StubStream(chunks=10)
+
+    async def disconnect():
+        subscriber = asyncio.ensure_future(take(coalescer.stream("k", upstream), 10))
+        await asyncio.sleep(0.025)
+        subscriber.cancel()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(disconnect())
+    assert upstream.closed
+    assert upstream.produced < 10
+    assert coalescer.stats()["in_flight"] == 0
+
+def test_upstream_continues_while_a_subscriber_remains():
+    coalescer = RequestCoalescer()
+    upstream = StubStream(chunks=10)
+
+    async def one_leaves():
+        stays = asyncio.ensure_future(take(coalescer.stream("k", upstream), 10))
+        await asyncio.sleep(0)
+        # Leaves after two chunks by closing its iterator
+        leaves = coalescer.stream("k", upstream)
+        assert await take(leaves, 2) == ["0", "1"]
+        await leaves.aclose()
+        return await stays
+
+    assert asyncio.run(one_leaves()) == [str(i) for i in range(10)]
+    assert upstream.produced == 10
+
+def test_new_subscriber_after_cancel_starts_a_fresh_stream():
+    coalescer = RequestCoalescer()
+    upstream = StubStream(chunks=3)
+
+    async def reconnect():
+        first = coalescer.stream("k", upstream)
+        await take(first, 1)
+        await first.aclose()
+        return await take(coalescer.stream("k", upstream), 3)
+
+    assert asyncio.run(reconnect()) == ["0", "1", "2"]
+    assert upstream.opened == 2
@@ -0,0 +1,42 @@
+"""
+SessionStore history selection against the token budget.
+"""
+from main import SessionStore, estimate_tokens
+
+def make_store():
+    return SessionStore(idle_seconds=3600, max_bytes=10_000_000, max_turns=50)
+
+def users(messages):
+    return [m["content"] for m in messages if m["role"] == "user"]
+
+def test_history_keeps_recent_turns_in_order():
+    store = make_store()
+    for i in range(3):
+        store.append("s", f"question {i}", f"answer {i}")
+    assert users(store.history("s", 1000)) == ["question 0", "question 1", "question 2"]
+
+def test_history_stops_at_first_turn_that_does_not_fit():
+    store = make_store()
+    store.append("s", "turn 1", "ok")
+    store.append("s", "turn 2 " + "x" * 4000, "ok")
+    store.append("s", "turn 3", "ok")
+    # Turn 1 would fit, but sending it without turn 2 would leave a gap
+    assert users(store.history("s", 100)) == ["turn 3"]
+
+def test_oversized_latest_turn_is_truncated():
+    store = make_store()
+    store.append("s", "turn 1", "ok")
+    store.append("s", "q" * 4000, "a" * 4000)
+    messages = store.history("s", 100)
+    assert len(messages) == 2
+    assert messages[0]["content"].startswith("qqq") and messages[0]["content"].endswith("[truncated]")
+    assert messages[1]["content"].startswith("aaa") and messages[1]["content"].endswith("[truncated]")
+    assert sum(estimate_tokens(m["content"]) for m in messages) <= 100
+
+def test_truncation_gives_unused_space_to_the_longer_side():
+    store = make_store()
+    store.append("s", "short question", "a" * 4000)
+    messages = store.history("s", 100)
+    assert messages[0]["content"] == "short question"
+    assert len(messages[1]["content"]) > 300
+    assert sum(estimate_tokens(m["content"]) for m in messages) <= 100